@@ -1,9 +1,12 @@
+import json
+from contextlib import nullcontext
 from datetime import datetime
 from pathlib import Path
 
+from db import DATABASE_FILE, DB
 from exceptions import UserError
-from exif import Exif
-from file_utils import path_file_walk, quote_path as qp, normalized_path
+from exif import BATCH_SIZE, Exif
+from file_utils import batched, path_stat_walk, quote_path as qp, normalized_path
 from jinja2 import Environment
 
 
@@ -13,10 +16,13 @@ class FileCommand(object):
     def __init__(self, config):
         self.verbose = config.verbose
         self.quiet = config.quiet
+        self.cache_dir = config.cache_dir
         self.src = normalized_path(config.src)
         self.dest = normalized_path(config.dest)
         self.hierarchy = config.hierarchy
         self.dry_run = config.dry_run
+        self.skip_dirs = config.skip_dirs
+        self.walk_threads = config.walk_threads
 
         if not self.src.exists():
             raise UserError(f"{self.src} does not exist")
@@ -41,13 +47,44 @@ class FileCommand(object):
         environment.filters['datetime'] = to_datetime
         return environment.from_string(self.hierarchy)
 
+    def iter_metadata(self, db, et):
+        # Yields (file, metadata, scanned) of files below src. Metadata of files unchanged since scan is read from the
+        # database, with scanned set, and exiftool is called once per batch for the others or all files without db.
+        for batch in batched(path_stat_walk(self.src, self.skip_dirs, self.walk_threads), BATCH_SIZE):
+            scanned = {}
+            if db is not None:
+                rows = {row['file_name']: row for row in db.image_select_by_file_names(file for file, _ in batch)}
+                for file, stat in batch:
+                    row = rows.get(str(file))
+                    if row and row['mtime'] == stat.st_mtime and row['size'] == stat.st_size:
+                        scanned[file] = json.loads(row['metadata'])
+            missing = [file for file, _ in batch if file not in scanned]
+            try:
+                extracted = dict(zip(missing, et.get_metadata_batch(missing)))
+            except Exception as e:
+                # Whole batch failed, ie. exiftool crashed, reported for each file like files that can't be read
+                extracted = dict.fromkeys(missing, e)
+            for file, _ in batch:
+                if file in scanned:
+                    yield file, scanned[file], True
+                else:
+                    yield file, extracted[file], False
+
+    def open_db(self):
+        # Without a database from scan there is nothing to read or update, so none is created
+        if (self.cache_dir / DATABASE_FILE).exists():
+            return DB(self.cache_dir)
+        return nullcontext()
+
+    def update_db(self, db, src, dest, metadata):
+        # Called after action() moved or copied src, which has a row from scan, to dest
+        pass
+
     def execute(self):
-        with Exif() as et:
-            for file in path_file_walk(self.src):
-                try:
-                    metadata = et.get_metadata(file)
-                except Exception as e:
-                    print(f"# ERROR rm {qp(file)} # {e}")
+        with self.open_db() as db, Exif() as et:
+            for file, metadata, scanned in self.iter_metadata(db, et):
+                if isinstance(metadata, Exception):
+                    print(f"# ERROR rm {qp(file)} # {metadata}")
                     continue
 
                 hierarchy = self.template.render(metadata).strip()
@@ -66,3 +103,5 @@ class FileCommand(object):
                             print(f"{self.action_name} {qp(file)} {qp(dest_path)}")
                         if not self.dry_run:
                             self.action(file, dest_path)
+                            if scanned:
+                                self.update_db(db, file, dest_path, metadata)
@@ -1,17 +1,23 @@
 import json
-import tempfile
-from functools import cmp_to_key
+import os
+import threading
 from itertools import groupby
 from pathlib import Path
 
+from commands.cluster import store_clusters
+from commands.scan import ScanCommand
 from db import DB
-from exif import Exif
+from exceptions import UserError
+from exif import ExifPool
+from file_utils import file_fingerprint
 from flask import Flask, render_template, request, send_file
-from learn.predictor import build_predictor
-from wand.image import Image
+from learn.predictor import Predictor
+from preview_cache import PREVIEW_SIZES, PreviewCache
+from server import serve
 from werkzeug.exceptions import abort
 from werkzeug.routing import PathConverter
 
+from similarity import DHASH_BYTES, MAX_DISTANCE
 from synology import get_thumbnail
 from collections import defaultdict
 from urllib.parse import quote
@@ -58,37 +64,83 @@ def ordered_tags(metadata):
     ]
     return ordered_keys
 
-def get_duplicates(et, rows, predictor):
-    duplicates = []
-    for dhash, group in groupby(rows, lambda x: x['dhash']):
-        metadata = [
-            et.get_metadata(row['file_name'])
+def get_duplicates(db, groups, predictor, exif_pool):
+    # groups is a list of (dhash, rows)
+    # Metadata stored by scan is used unless the file was modified since
+    page_metadata = {}
+    stale = {}
+    for _, group in groups:
+        for row in group:
+            try:
+                stat = Path(row['file_name']).stat()
+            except OSError:
+                continue
+            if stat.st_mtime == row['mtime'] and stat.st_size == row['size']:
+                page_metadata[row['file_name']] = json.loads(row['metadata'])
+            else:
+                stale[row['file_name']] = (row, stat)
+    if stale:
+        page_metadata.update(refresh_metadata(db, stale, exif_pool))
+
+    page = [
+        [
+            page_metadata[row['file_name']]
             for row in group
-            if Path(row['file_name']).exists()
+            if row['file_name'] in page_metadata
         ]
-        if len(metadata) > 1:
-            duplicates.append(
-                {
-                    'images': sorted(metadata, key=cmp_to_key(predictor)),
-                    'tags': ordered_tags(metadata)
-                }
-            )
-    return duplicates
+        for _, group in groups
+    ]
+    page = [metadata for metadata in page if len(metadata) > 1]
+
+    return [
+        {
+            'images': images,
+            'tags': ordered_tags(metadata)
+        }
+        for metadata, images in zip(page, predictor(db, page))
+    ]
+
+
+def refresh_metadata(db, stale, exif_pool):
+    # stale[file_name] = (row, stat) of modified files. Reads them again in one batch and updates the DB like scan. 
+    # Returns metadata of files that still have the same dhash.
+    files = [Path(file_name) for file_name in stale]
+    with exif_pool.get() as et:
+        results = ScanCommand.extract_batch(et, files)
 
+    metadata = {}
+    for file, result in zip(files, results):
+        if isinstance(result, Exception):
+            continue
+        row, stat = stale[str(file)]
+        ScanCommand.store_file(db, file, stat, file_fingerprint(file, stat.st_size), *result)
+        file_metadata, dhash, _ = result
+        if dhash == row['dhash']:
+            metadata[str(file)] = file_metadata
+    return metadata
 
-def get_alerts(duplicates):
+
+def get_alerts(db, duplicates):
     # alert[source_file] = ['<p>alert1</p>', '<p>alert2</p>']
     alerts = defaultdict(list)
 
+    # Files with the same stem as any image on the page, from the database instead of listing directories
+    siblings = defaultdict(list)
+    for row in db.image_select_siblings(image['SourceFile'] for group in duplicates for image in group['images']):
+        siblings[(row['directory'], row['stem'])].append(Path(row['file_name']))
+
     for group in duplicates:
         source_files = [Path(image['SourceFile']) for image in group['images']]
     
-        # Live Photos
+        # Live Photos and RAW+JPEG
         for source_file in source_files:
-            # Search for files with the same stem that are not in the duplicates group
-            for live_photo in [str(f) for f in source_file.parent.glob(f'{source_file.stem}.MOV') if f not in source_files]:
-                live_photo_url = quote(live_photo)
-                alerts[str(source_file)].append(f'Possible live photo <a href="/image/{live_photo_url}" class="alert-link">{live_photo}</a>')
+            # Files with the same stem that are not in the duplicates group
+            for sibling in siblings[(str(source_file.parent), source_file.stem)]:
+                if sibling in source_files:
+                    continue
+                sibling_url = quote(str(sibling))
+                kind = 'live photo' if sibling.suffix.upper() == '.MOV' else 'file with the same name'
+                alerts[str(source_file)].append(f'Possible {kind} <a href="/image/{sibling_url}" class="alert-link">{sibling}</a>')
 
         # Mismatched numbers
         # Finds first group of numbers in the filename
@@ -100,95 +152,164 @@ def get_alerts(duplicates):
     return alerts
 
 
+# Images browsers show as they are with size=original, others are converted to a full size JPEG
+BROWSER_IMAGE_TYPES = {'image/jpeg', 'image/png', 'image/gif', 'image/webp'}
+
+
 class BrowseCommand(object):
 
     def __init__(self, config):
         self.cache_dir = config.cache_dir
+        self.max_distance = config.max_distance
+        self.clusters = config.clusters
+        self.threads = config.threads
+        self.exif_pool = ExifPool(config.exif_processes)
+        self._local = threading.local()
+        self._similar_lock = threading.Lock()
+        self.previews = PreviewCache(self.cache_dir / 'previews', config.preview_cache_size * 1024 * 1024)
+        if not 0 <= self.max_distance <= MAX_DISTANCE:
+            raise UserError(f"--max-distance must be between 0 and {MAX_DISTANCE}")
+        if self.threads < 1 or config.exif_processes < 1:
+            raise UserError("--threads and --exif-processes must be at least 1")
 
     def execute(self):
         app = Flask(__name__, )
         app.url_map.converters['everything'] = EverythingConverter
         app.config['TESTING'] = True
 
+        predictor = Predictor(self.cache_dir)
         with DB(self.cache_dir) as db:
-            predictor = build_predictor(db, self.cache_dir)
+            stale = predictor.is_stale(db)
+            if self.max_distance:
+                # Connected groups of similar hashes, found once so pages only read groups of duplicates from an index
+                # Images inserted later, ie. by scan, are added to the groups by index()
+                self._similar_rowid = db.image_select_last_rowid()
+                rows = [row for row in db.dhash_select_clusters() if len(row['dhash']) == DHASH_BYTES]
+                print(f"# Grouping {len(rows)} hashes")
+                store_clusters(
+                    db,
+                    [row['dhash'] for row in rows],
+                    self.max_distance,
+                    table='similar_groups',
+                    counts=[row['count'] for row in rows]
+                )
+        if stale:
+            # Serve with the previous model until the new one is fitted
+            threading.Thread(target=self.train, args=(predictor,), daemon=True).start()
+
+        @app.teardown_request
+        def flush(exception):
+            # Write rows of files refreshed by get_duplicates()
+            if hasattr(self._local, 'db'):
+                self._local.db.flush()
 
         @app.route('/')
         def index():
-            with DB(self.cache_dir) as db:
-                with Exif() as et:
-                    start = bytes.fromhex(request.args.get('start', ''))
-                    rows = db.image_select_duplicate_dhash(start).fetchall()
-
-                    duplicates = get_duplicates(et, rows, predictor)
-
-                    if duplicates:
-                        alerts = get_alerts(duplicates)
-
-                        last_dhash = rows[-1]['dhash']
-                        # Maximum hash value as a long
-                        percentage = (100 * int.from_bytes(last_dhash, "big")) / 340282366920938463463374607431768211455
-                        return render_template(
-                            'index.html',
-                            duplicates=duplicates,
-                            alerts=alerts,
-                            percentage=percentage,
-                            last_dhash = last_dhash.hex()
-                        )
-                    else:
-                        return render_template('empty.html')
+            db = self.db()
+            start = bytes.fromhex(request.args.get('start', ''))
+            if self.clusters:
+                groups = db.image_select_cluster_groups(start)
+            elif self.max_distance:
+                with self._similar_lock:
+                    self._similar_rowid = db.similar_groups_extend(self._similar_rowid, self.max_distance)
+                groups = db.image_select_cluster_groups(start, table='similar_groups')
+            else:
+                rows = db.image_select_duplicate_dhash(start).fetchall()
+                groups = [(dhash, list(group)) for dhash, group in groupby(rows, lambda x: x['dhash'])]
+
+            duplicates = get_duplicates(db, groups, predictor, self.exif_pool)
+
+            if duplicates:
+                alerts = get_alerts(db, duplicates)
+
+                last_dhash = groups[-1][0]
+                if self.clusters or self.max_distance:
+                    # Maximum hash value as a long
+                    percentage = (100 * int.from_bytes(last_dhash, "big")) / 340282366920938463463374607431768211455
+                    group_count = None
+                else:
+                    position, group_count = db.dhash_groups_progress(last_dhash)
+                    percentage = 100 * position / group_count
+                return render_template(
+                    'index.html',
+                    duplicates=duplicates,
+                    alerts=alerts,
+                    percentage=percentage,
+                    group_count=group_count,
+                    last_dhash = last_dhash.hex()
+                )
+            else:
+                return render_template('empty.html')
 
         @app.route('/image/<everything:file_name>', methods=['GET', 'DELETE', 'POST'])
         def serve_pictures(file_name):
-            with DB(self.cache_dir) as db:
-                file = Path(file_name)
-                row = db.image_select_by_file_name(file)
-                if not row:
-                    abort(404)
-                if request.method == 'GET':
-                    return self.send_image(file)
-                elif request.method == 'DELETE':
-                    return self.delete_image(db, row, self.cache_dir)
-                elif request.method == 'POST':
-                    return self.ignore_image(db, row)
+            db = self.db()
+            file = Path(file_name)
+            row = db.image_select_by_file_name(file)
+            if not row:
+                abort(404)
+            if request.method == 'GET':
+                size = request.args.get('size', 'XL')
+                if size not in PREVIEW_SIZES:
+                    abort(400)
+                return self.send_image(file, row, size)
+            elif request.method == 'DELETE':
+                return self.delete_image(db, row)
+            elif request.method == 'POST':
+                return self.ignore_image(db, row)
                     
-        app.run(host='0.0.0.0', port=8000)
+        try:
+            serve(app, '0.0.0.0', 8000, self.threads, on_thread_exit=self.close_db)
+        finally:
+            self.exif_pool.close()
 
-    @staticmethod
-    def send_image(file):
-        thumbnail = get_thumbnail(file, size="XL")
-        if thumbnail.exists():
-            return send_file(str(thumbnail))
-        elif file.suffix == '.HEIC':
-            with Image(filename=str(file)) as img:
-                with tempfile.NamedTemporaryFile(prefix=file.name, suffix='.JPG', delete=True) as fp:
-                    img.format = 'jpeg'
-                    img.save(filename=fp.name)
-                    return send_file(fp.name)
+    def db(self):
+        # Each server thread keeps its connection open between requests
+        if not hasattr(self._local, 'db'):
+            self._local.db = DB(self.cache_dir).__enter__()
+        return self._local.db
+
+    def close_db(self):
+        # Called by each server thread on exit, as connections can only be closed by the thread that opened them
+        if hasattr(self._local, 'db'):
+            self._local.db.__exit__(None, None, None)
+            del self._local.db
+
+    def train(self, predictor):
+        with DB(self.cache_dir) as db:
+            predictor.train(db)
+
+    def send_image(self, file, row, size):
+        # Files are opened before they are sent so a preview evicted meanwhile is still served
+        mime_type = json.loads(row['metadata'])['MIMEType']
+        thumbnail = get_thumbnail(file, size=size)
+        if size != 'original' and thumbnail.exists():
+            f = open(thumbnail, 'rb')
+            stat = os.fstat(f.fileno())
+            etag = PreviewCache.key(thumbnail, stat, size)
+            mime_type = 'image/jpeg'
+        elif mime_type.startswith('image/') and not (size == 'original' and mime_type in BROWSER_IMAGE_TYPES):
+            stat = file.stat()
+            f, etag = self.previews.open(file, stat, size)
+            mime_type = 'image/jpeg'
         else:
-            return send_file(str(file))
+            f = open(file, 'rb')
+            stat = os.fstat(f.fileno())
+            etag = PreviewCache.key(file, stat, 'original')
 
-    @staticmethod
-    def delete_image(db, row, cache_dir):
-        file_name = row['file_name']
+        # Let the browser revalidate with If-None-Match instead of downloading again
+        response = send_file(f, mimetype=mime_type)
+        response.content_length = os.fstat(f.fileno()).st_size
+        response.set_etag(etag)
+        response.last_modified = stat.st_mtime
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
 
-        # Log metadata
-        data = (
-            row['dhash'].hex(),
-            json.loads(row['metadata'])
-        )
-        data_json = json.dumps(data)
-        with tempfile.NamedTemporaryFile(
-            dir=cache_dir,
-            mode='w',
-            delete=False,
-            prefix='img',
-            suffix='.json'
-        ) as log:
-            log.write(data_json)
-
-        db.image_delete(file_name)
-        Path(file_name).unlink()
+    def delete_image(self, db, row):
+        file = Path(row['file_name'])
+        db.image_delete(file, log=True)
+        self.previews.remove(file, file.stat())
+        file.unlink()
         return 'True'
 
     @staticmethod
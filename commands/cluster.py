@@ -0,0 +1,66 @@
+import numpy as np
+
+from db import DB
+from exceptions import UserError
+from similarity import DHASH_BYTES, MAX_DISTANCE, cluster
+
+
+def store_clusters(db, hashes, max_distance, table='duplicate_groups', counts=None):
+    # Replace the groups in table with the connected groups of hashes at most max_distance bits apart. Given counts,
+    # the number of images of each hash, groups of one image are left out.
+    clusters = cluster(hashes, max_distance)
+    groups = zip(hashes, clusters)
+    if counts is not None:
+        images = np.bincount(clusters, weights=counts, minlength=len(hashes))
+        groups = ((dhash, group) for dhash, group in groups if images[group] > 1)
+    db.duplicate_groups_update(
+        ((dhash, hashes[group]) for dhash, group in groups),
+        clear=True,
+        table=table
+    )
+    return clusters
+
+
+class ClusterCommand(object):
+
+    def __init__(self, config):
+        self.verbose = config.verbose
+        self.quiet = config.quiet
+        self.cache_dir = config.cache_dir
+        self.max_distance = config.max_distance
+        self.incremental = config.incremental
+        if not 0 <= self.max_distance <= MAX_DISTANCE:
+            raise UserError(f"--max-distance must be between 0 and {MAX_DISTANCE}")
+
+    def execute(self):
+        with DB(self.cache_dir) as db:
+            rows = [row for row in db.dhash_select_clusters() if len(row['dhash']) == DHASH_BYTES]
+            hashes = [row['dhash'] for row in rows]
+            if self.incremental:
+                # Only compare hashes that are new or whose group lost a hash against the rest. Groups that lost a
+                # hash are split into their own hashes first so they are only joined again where still connected.
+                broken = db.duplicate_groups_select_broken()
+                positions = {dhash: i for i, dhash in enumerate(hashes)}
+                new = np.array([
+                    row['group_dhash'] not in positions or row['group_dhash'] in broken
+                    for row in rows
+                ], dtype=bool)
+                groups = [i if new[i] else positions[row['group_dhash']] for i, row in enumerate(rows)]
+                if self.verbose:
+                    print(f"# Comparing {new.sum()} new hashes, {len(broken)} groups broken by deletions, with "
+                          f"{len(hashes)} hashes")
+                clusters = cluster(hashes, self.max_distance, groups, new)
+                changed = [
+                    (dhash, hashes[group])
+                    for dhash, group, row in zip(hashes, clusters, rows)
+                    if row['group_dhash'] != hashes[group]
+                ]
+                db.duplicate_groups_update(changed)
+            else:
+                if self.verbose:
+                    print(f"# Comparing {len(hashes)} hashes")
+                clusters = store_clusters(db, hashes, self.max_distance)
+
+            if not self.quiet:
+                sizes = np.bincount(clusters, minlength=len(hashes)) if clusters else np.array([])
+                print(f"# {len(hashes)} hashes in {(sizes > 1).sum()} groups of similar hashes")
@@ -0,0 +1,19 @@
+from db import DB
+
+
+class CompactCommand(object):
+
+    def __init__(self, config):
+        self.quiet = config.quiet
+        self.cache_dir = config.cache_dir
+        self.sample_size = config.sample_size
+
+    def execute(self):
+        database_file = self.cache_dir / "shashin.sqlite3"
+        with DB(self.cache_dir) as db:
+            size = database_file.stat().st_size
+            count = db.metadata_compact(self.sample_size)
+            db.vacuum()
+        if not self.quiet:
+            print(f"# Encoded metadata of {count} rows")
+            print(f"# Database size {size / 2 ** 20:.1f} MB -> {database_file.stat().st_size / 2 ** 20:.1f} MB")
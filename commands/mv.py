@@ -1,5 +1,7 @@
 import shutil
 
+from exif import relocate_metadata
+
 from ._file import FileCommand
 
 
@@ -10,3 +12,8 @@ class MoveCommand(FileCommand):
     def action(src, dest):
         assert not dest.exists() # Sanity check
         shutil.move(src, dest)
+
+    def update_db(self, db, src, dest, metadata):
+        # Point the row of src at dest so the next scan doesn't purge it and hash dest again
+        mtime = dest.stat().st_mtime
+        db.image_move(src, dest, mtime, relocate_metadata(metadata, dest, mtime))
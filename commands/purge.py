@@ -0,0 +1,20 @@
+from pathlib import Path
+
+from db import DB
+
+
+class PurgeCommand(object):
+
+    def __init__(self, config):
+        self.quiet = config.quiet
+        self.cache_dir = config.cache_dir
+
+    def execute(self):
+        with DB(self.cache_dir) as db:
+            db.image_purge(self.file_missing)
+
+    def file_missing(self, row):
+        is_missing = not Path(row['file_name']).exists()
+        if is_missing and not self.quiet:
+            print(f"# DELETE {row['file_name']}")
+        return is_missing
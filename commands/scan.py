@@ -1,15 +1,108 @@
-import sqlite3
+import json
+import os
+import subprocess
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from itertools import chain, repeat
+from multiprocessing import util
 from pathlib import Path
 
 from db import DB
 from dhash import dhash_row_col, format_bytes
 from exceptions import UserError
-from exif import Exif
-from file_utils import normalized_path, path_file_walk, quote_path as qp
+from exif import BATCH_SIZE, Exif, relocate_metadata
+from file_utils import batched, file_fingerprint, normalized_path, path_stat_walk, quote_path as qp
+from learn.features import image_features, pack_features
+from preview_cache import PreviewCache
+from stat_index import StatIndex
 from wand.image import Image
 
 from synology import get_thumbnail
 
+# Number of batches queued per worker process before the writer waits for results
+QUEUE_FACTOR = 4
+
+# Smallest size JPEGs are decoded at with --fast-decode. Synology SM thumbnails, which are already used for dhash, are
+# 240 pixels.
+DECODE_SIZE_HINT = '256x256'
+# Embedded previews of RAW and HEIC files used with --fast-decode
+PREVIEW_TAGS = ['PreviewImage', 'JpgFromRaw']
+
+# Added to the niceness of scan with --nice
+NICE_INCREMENT = 10
+
+# ExifTool process and preview cache owned by a worker process
+_worker_et = None
+_worker_previews = None
+
+
+def _init_worker(previews=None):
+    # previews is (directory, max_bytes) of the preview cache to store previews in while hashing
+    global _worker_et
+    _worker_et = Exif()
+    _worker_et.start()
+    # Shut down exiftool when the worker process exits
+    util.Finalize(_worker_et, _worker_et.terminate, exitpriority=10)
+    if previews:
+        _init_preview_worker(*previews)
+
+
+def _init_preview_worker(directory, max_bytes):
+    # Only file lists are sent to workers, the cache and its count of total bytes live as long as the worker
+    global _worker_previews
+    _worker_previews = PreviewCache(directory, max_bytes)
+
+
+def _extract_in_worker(files, **kwargs):
+    return ScanCommand.extract_batch(_worker_et, files, previews=_worker_previews, **kwargs)
+
+
+def _create_previews(files):
+    # Returns whether a preview was created or the exception raised for each file
+    previews = _worker_previews
+    results = []
+    for file in files:
+        try:
+            stat = file.stat()
+            # Browse serves Synology thumbnails when they exist
+            created = not get_thumbnail(file, 'XL').exists() and not previews.exists(file, stat)
+            if created:
+                previews.open(file, stat)[0].close()
+            results.append(created)
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def _try_fingerprint(file_stat):
+    file, stat = file_stat
+    try:
+        return file_fingerprint(file, stat.st_size)
+    except OSError as e:
+        return e
+
+
+def _lower_priority():
+    # Inherited by worker processes and exiftool
+    os.nice(NICE_INCREMENT)
+    try:
+        # Idle IO class, only gets disk time when no other process needs it
+        subprocess.run(['ionice', '-c', '3', '-p', str(os.getpid())],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except FileNotFoundError:
+        pass
+
+
+def _run_inline(fn, *args, **kwargs):
+    # Serial counterpart of executor.submit()
+    future = Future()
+    try:
+        future.set_result(fn(*args, **kwargs))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
 
 class ScanCommand(object):
 
@@ -17,71 +110,268 @@ class ScanCommand(object):
         self.verbose = config.verbose
         self.quiet = config.quiet
         self.cache_dir = config.cache_dir
+        self.jobs = config.jobs
+        self.skip_dirs = config.skip_dirs
+        self.walk_threads = config.walk_threads
+        self.fast_decode = config.fast_decode
+        self.previews = config.previews
+        self.preview_jobs = config.preview_jobs
+        self.nice = config.nice
+        self.preview_cache = PreviewCache(self.cache_dir / 'previews', config.preview_cache_size * 1024 * 1024)
         self.scan_dirs = [normalized_path(scan_dir) for scan_dir in config.scan_dirs]
         for scan_dir in self.scan_dirs: 
             if not scan_dir.exists():
                 raise UserError(f"{scan_dir} does not exist")
+        if self.jobs < 1:
+            raise UserError("--jobs must be at least 1")
+        if self.preview_jobs < 1:
+            raise UserError("--preview-jobs must be at least 1")
 
     def execute(self):
+        if self.nice:
+            _lower_priority()
+        # With --previews all, previews are made from the images decoded for hashing
+        extract = partial(
+            self.extract_batch,
+            fast_decode=self.fast_decode,
+            previews=self.preview_cache if self.previews == 'all' else None
+        )
         with DB(self.cache_dir) as db:
-            with Exif() as et:
-                for scan_dir in self.scan_dirs:
-                    for file in path_file_walk(scan_dir):
-                        try:
-                            action = self.scan_file(db, et, file)
-                        except Exception as e:
-                            print(f"# ERROR rm {qp(file)} # {e}")
-                            continue
-                        if self.verbose and action is None:
-                            print(f"# SKIPPED {file}")
-                        elif not self.quiet and action:
-                            print(f"{action.upper()} {qp(file)}")
-            self.scan_db(db)
+            index = StatIndex(chain.from_iterable(db.image_select_stats(scan_dir) for scan_dir in self.scan_dirs))
+            if self.verbose:
+                print(f"# Loaded {len(index)} files into stat index ({index.nbytes / 2**20:.1f} MB)")
+            if not index.complete:
+                print("# WARNING stat index is full, files outside it will be checked in the database")
+            if self.jobs > 1:
+                with ProcessPoolExecutor(
+                    self.jobs,
+                    initializer=_init_worker,
+                    initargs=(self.preview_args() if self.previews == 'all' else None,)
+                ) as executor:
+                    submit = partial(executor.submit, _extract_in_worker, fast_decode=self.fast_decode)
+                    seen = self.scan(db, index, submit, self.jobs * QUEUE_FACTOR)
+            else:
+                with Exif() as et:
+                    submit = partial(_run_inline, extract, et)
+                    seen = self.scan(db, index, submit, 0)
+            self.scan_db(db, seen)
+            if self.previews:
+                self.create_previews(db)
 
-    @classmethod
-    def scan_file(cls, db, et, file):
-        # Check if file is already in DB
-        stat = file.stat()
-        row = db.image_select_by_file_name_stats(
-            str(file), stat.st_mtime, stat.st_size)
-        if row:
+    def scan(self, db, index, submit, queue_size):
+        # Files are walked, checked and written in order by this process, only extract_batch() is handed to submit().
+        # Results are consumed in walk order so the output is the same for any number of jobs.
+        queue = deque()
+        seen = set()
+        fingerprint_pool = ThreadPoolExecutor(self.walk_threads)
+        # Rows scanned before fingerprints were stored
+        unfingerprinted = set(
+            row['file_name']
+            for scan_dir in self.scan_dirs
+            for row in db.image_select_missing_fingerprint(scan_dir)
+        )
+        for scan_dir in self.scan_dirs:
+            for files in batched(path_stat_walk(scan_dir, self.skip_dirs, self.walk_threads), BATCH_SIZE):
+                checks = []
+                for file, stat in files:
+                    seen.add(str(file))
+                    try:
+                        checks.append(self.check_file(db, index, file, stat))
+                    except Exception as e:
+                        checks.append(e)
+                # Read the files to fingerprint in parallel, the reads are small and dominated by latency
+                fingerprinted = [
+                    (file, stat)
+                    for (file, stat), changed in zip(files, checks)
+                    if changed is True or (changed is False and str(file) in unfingerprinted)
+                ]
+                fingerprints = dict(zip(
+                    (file for file, _ in fingerprinted),
+                    fingerprint_pool.map(_try_fingerprint, fingerprinted)
+                ))
+                entries = []
+                updates = []
+                for (file, stat), changed in zip(files, checks):
+                    fingerprint = fingerprints.get(file)
+                    try:
+                        if isinstance(changed, Exception):
+                            raise changed
+                        if isinstance(fingerprint, Exception):
+                            raise fingerprint
+                        if not changed:
+                            entry = (file, None, None, None)
+                            if fingerprint:
+                                updates.append((file, fingerprint))
+                        elif self.move_file(db, seen, file, stat, fingerprint):
+                            entry = (file, None, None, 'move')
+                        else:
+                            entry = (file, stat, fingerprint, None)
+                    except Exception as e:
+                        entry = (file, None, None, e)
+                    entries.append(entry)
+                if updates:
+                    db.image_update_fingerprints(updates)
+                changed = [file for file, stat, _, _ in entries if stat]
+                queue.append((entries, submit(changed) if changed else None))
+                while len(queue) > queue_size:
+                    self.finish_batch(db, *queue.popleft())
+        while queue:
+            self.finish_batch(db, *queue.popleft())
+        fingerprint_pool.shutdown()
+        return seen
+
+    def finish_batch(self, db, entries, future):
+        try:
+            results = iter(future.result() if future else [])
+        except Exception as e:
+            # Whole batch failed, ie. exiftool crashed
+            results = repeat(e)
+        for file, stat, fingerprint, outcome in entries:
+            action = outcome
+            try:
+                if isinstance(outcome, Exception):
+                    raise outcome
+                if stat:
+                    result = next(results)
+                    if isinstance(result, Exception):
+                        raise result
+                    action = self.store_file(db, file, stat, fingerprint, *result)
+            except Exception as e:
+                print(f"# ERROR rm {qp(file)} # {e}")
+                continue
+            if self.verbose and action is None:
+                print(f"# SKIPPED {file}")
+            elif not self.quiet and action:
+                print(f"{action.upper()} {qp(file)}")
+
+    @staticmethod
+    def check_file(db, index, file, stat):
+        # Returns True if file is missing from DB or has been modified
+        stats = (file, stat.st_mtime, stat.st_size)
+        if stats in index:
             # File in db and unchanged
-            return
-        
-        # File is missing from DB or has been modified
-        metadata = et.get_metadata(file)
-        
-        dhash = None
-        if metadata['MIMEType'].startswith('image/'):
-            dhash = cls.calculate_dhash(file)
+            return False
+        if not index.complete and db.image_select_by_file_name_stats(*stats):
+            return False
+        return True
+
+    @staticmethod
+    def move_file(db, seen, file, stat, fingerprint):
+        # Point the row of a vanished file with the same fingerprint at file instead of extracting it again. The
+        # fingerprint only covers the size, head and tail so it is a candidate key, not proof of identical content, and
+        # the vanished file can't be compared. A file edited in the middle without changing its size could be taken
+        # for a moved file and keep the old dhash, which purge and scan of the old row would otherwise have fixed.
+        for row in db.image_select_by_fingerprint(fingerprint):
+            if (
+                row['file_name'] not in seen 
+                and row['size'] == stat.st_size 
+                and not Path(row['file_name']).exists()
+            ):
+                metadata = relocate_metadata(json.loads(row['metadata']), file, stat.st_mtime)
+                db.image_move(row['file_name'], file, stat.st_mtime, metadata)
+                return True
+        return False
+
+    @classmethod
+    def extract_batch(cls, et, files, fast_decode=False, previews=None):
+        # Returns (metadata, dhash, features) or the exception raised for each file
+        results = []
+        for file, metadata in et.iter_metadata(files):
+            if not isinstance(metadata, Exception):
+                try:
+                    dhash = None
+                    features = None
+                    if metadata['MIMEType'].startswith('image/'):
+                        dhash = cls.calculate_dhash(file, et, metadata, fast_decode, previews)
+                        # Only images are ranked by the predictor
+                        features = pack_features(image_features(metadata))
+                    metadata = (metadata, dhash, features)
+                except Exception as e:
+                    metadata = e
+            results.append(metadata)
+        return results
 
+    @staticmethod
+    def store_file(db, file, stat, fingerprint, metadata, dhash, features):
         data = {
             'mtime': stat.st_mtime,
             'size': stat.st_size,
             'dhash': dhash,
             'metadata': metadata,
+            'fingerprint': fingerprint,
+            'features': features,
         }
         db.image_insert_or_replace(
             file_name=file,
             **data
         )
-        if row:
-            return 'update'
-        else:
-            return 'insert'
+        return 'insert'
 
-    @staticmethod
-    def calculate_dhash(file):
+    @classmethod
+    def calculate_dhash(cls, file, et=None, metadata=None, fast_decode=False, previews=None):
         thumbnail = get_thumbnail(file)
         if thumbnail.exists(): 
-            file = thumbnail
-        with Image(filename=str(file)) as image:
-            return sqlite3.Binary(format_bytes(*dhash_row_col(image)))
-
-    def scan_db(self, db):
-        def file_missing(row):
-            is_missing = not Path(row['file_name']).exists()
-            if is_missing and not self.quiet:
-                print(f"# DELETE {row['file_name']}")
-            return is_missing
-        db.image_purge(file_missing)
+            return cls.read_dhash(thumbnail)
+        return cls.read_dhash(file, et, metadata, fast_decode, previews)
+
+    @staticmethod
+    def read_dhash(file, et=None, metadata=None, fast_decode=False, previews=None):
+        with Image() as image:
+            if fast_decode:
+                # Use an embedded preview of formats that can't be scaled while decoding
+                preview_tags = [tag for tag in PREVIEW_TAGS if tag in metadata and metadata['MIMEType'] != 'image/jpeg']
+                blob = et.get_preview(file, preview_tags[0]) if preview_tags else None
+                # Let libjpeg scale down with DCT while decoding
+                image.options['jpeg:size'] = DECODE_SIZE_HINT
+                if blob:
+                    image.read(blob=blob)
+                else:
+                    image.read(filename=str(file))
+            else:
+                image.read(filename=str(file))
+                if previews:
+                    try:
+                        previews.put(file, file.stat(), image)
+                    except Exception:
+                        # Not fatal for the scan, create_previews() tries again and reports the error
+                        pass
+            # bytes rather than sqlite3.Binary so the hash can be pickled from worker processes
+            return format_bytes(*dhash_row_col(image))
+
+    def preview_args(self):
+        return self.preview_cache.directory, self.preview_cache.max_bytes
+
+    def scan_db(self, db, seen):
+        # Files below the scanned directories that were not walked are missing
+        for scan_dir in self.scan_dirs:
+            for file_name in db.image_purge_unseen(scan_dir, seen):
+                if not self.quiet:
+                    print(f"# DELETE {file_name}")
+
+    def create_previews(self, db):
+        # Images hashed with --fast-decode or in earlier scans are decoded again by a pool of preview-jobs processes
+        with ProcessPoolExecutor(
+            self.preview_jobs,
+            initializer=_init_preview_worker,
+            initargs=self.preview_args()
+        ) as executor:
+            queue = deque()
+            for scan_dir in self.scan_dirs:
+                rows = db.image_select_hashed(scan_dir, self.previews == 'duplicates')
+                for files in batched((Path(row['file_name']) for row in rows), BATCH_SIZE):
+                    queue.append((files, executor.submit(_create_previews, files)))
+                    while len(queue) > self.preview_jobs * QUEUE_FACTOR:
+                        self.finish_previews(*queue.popleft())
+            while queue:
+                self.finish_previews(*queue.popleft())
+
+    def finish_previews(self, files, future):
+        try:
+            results = future.result()
+        except Exception as e:
+            results = repeat(e)
+        for file, result in zip(files, results):
+            if isinstance(result, Exception):
+                print(f"# ERROR preview {qp(file)} # {result}")
+            elif self.verbose and result:
+                print(f"# PREVIEW {file}")
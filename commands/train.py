@@ -0,0 +1,29 @@
+from db import DB
+from learn.predictor import Predictor, compare
+
+
+class TrainCommand(object):
+
+    def __init__(self, config):
+        self.quiet = config.quiet
+        self.cache_dir = config.cache_dir
+        self.force = config.force
+        self.compare = config.compare
+
+    def execute(self):
+        predictor = Predictor(self.cache_dir)
+        with DB(self.cache_dir) as db:
+            if self.compare:
+                result = compare(db)
+                if result is None:
+                    print("# Not enough deleted images to compare")
+                else:
+                    pairs, accuracy, legacy_accuracy = result
+                    print(f"# Accuracy on {pairs} held-out pairs: {accuracy:.3f} with feature vectors, "
+                          f"{legacy_accuracy:.3f} with the pandas pipeline used before")
+                return
+            if not self.force and not predictor.is_stale(db):
+                if not self.quiet:
+                    print("# Model is up to date")
+                return
+            predictor.train(db)
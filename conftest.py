@@ -0,0 +1 @@
+# Makes pytest add the repository root to sys.path so tests import modules like learn and db directly
@@ -1,10 +1,65 @@
+import os
+import random
 import sqlite3
+import time
+from itertools import groupby
 from pathlib import Path
 import json
 
+import metadata_codec
+from similarity import DHASH_BLOCKS, DHASH_BYTES, block_expression, dhash_blocks, hamming_distance
+
+# Name of the database in the cache directory
+DATABASE_FILE = 'shashin.sqlite3'
+
+# Buffered image rows are written in one transaction every FLUSH_ROWS rows or FLUSH_SECONDS seconds
+FLUSH_ROWS = 1000
+FLUSH_SECONDS = 5.0
+# Rows read at a time by migrations and metadata_compact() that go through whole tables
+CHUNK_ROWS = 10000
+
+# Tags copied from metadata to indexed columns named tag_<tag> for image_select_tags(). Columns of tags added here are
+# created and filled when the database is next opened.
+HOT_TAGS = ['MIMEType', 'DateTimeOriginal', 'Keywords', 'Model', 'ImageSize']
+TAG_COLUMNS = [f'tag_{tag}' for tag in HOT_TAGS]
+
+# Tables of (dhash, group_dhash) read by image_select_cluster_groups()
+GROUP_TABLES = ['duplicate_groups', 'similar_groups']
+
+# Condition matching root and every file below it as a range scan on the primary key, see _below_params()
+BELOW_ROOT = '(file_name = :root OR (file_name >= :start AND file_name < :end))'
+
+
+def _tag_values(metadata):
+    # Lists, ie. several Keywords, are stored as JSON
+    return [
+        json.dumps(value) if isinstance(value, list) else value
+        for value in (metadata.get(tag) for tag in HOT_TAGS)
+    ]
+
+
+def _directory_stem(file_name):
+    path = Path(file_name)
+    return str(path.parent), path.stem
+
+
+def _below_params(root):
+    # file_name range [start, end) of every path below root
+    start = os.path.join(str(root), '')
+    end = start[:-1] + chr(ord(os.sep) + 1)
+    return {
+        'root': str(root),
+        'start': start,
+        'end': end,
+    }
+
+
 class DB(object):
     def __init__(self, cache_dir):
-        self._database_file = cache_dir / "shashin.sqlite3"
+        self._cache_dir = cache_dir
+        self._database_file = cache_dir / DATABASE_FILE
+        self._image_buffer = []
+        self._last_flush = time.monotonic()
 
     def __enter__(self):
         self._db_connection = sqlite3.connect(str(self._database_file), timeout=30.0)
@@ -13,8 +68,12 @@ class DB(object):
         return self
 
     def __exit__(self, exc_class, exc, traceback):
-        self._db_connection.commit()
-        self._db_connection.close()
+        # Write buffered rows even on an error or Ctrl-C so the work done so far isn't lost
+        try:
+            self.flush()
+        finally:
+            self._db_connection.commit()
+            self._db_connection.close()
 
     def _execute(self, query, *params):
         return self._db_cur.execute(query, *params)
@@ -25,13 +84,20 @@ class DB(object):
     def _init_db(self):
         self._database_file.parent.mkdir(parents=True, exist_ok=True)
         self._db_cur.executescript(r'''
+        -- Allow browse to read while scan is writing
+        PRAGMA journal_mode = WAL;
+        PRAGMA synchronous = NORMAL;
+        -- Fire the delete triggers of rows replaced by INSERT OR REPLACE
+        PRAGMA recursive_triggers = ON;
+
         CREATE TABLE IF NOT EXISTS images 
         (
             file_name TEXT PRIMARY KEY,
             mtime FLOAT NOT NULL,
             size INT NOT NULL,
             dhash BLOB,
-            metadata TEXT NOT NULL
+            metadata TEXT NOT NULL,
+            fingerprint BLOB
         );
 
         CREATE INDEX IF NOT EXISTS idx_dhash ON images 
@@ -44,20 +110,328 @@ class DB(object):
             dhash BLOB PRIMARY KEY
         );
 
+        -- Feature vectors of the predictor for images, see learn.features
+        CREATE TABLE IF NOT EXISTS image_features 
+        (
+            file_name TEXT PRIMARY KEY,
+            version INT NOT NULL,
+            indices BLOB NOT NULL,
+            data BLOB NOT NULL
+        );
+
+        CREATE TRIGGER IF NOT EXISTS images_delete_image_features AFTER DELETE ON images 
+        BEGIN
+            DELETE FROM image_features WHERE file_name = OLD.file_name;
+        END;
+
+        -- Features are computed from metadata, which is only changed with file_name by image_move(). metadata_compact()
+        -- re-encodes metadata without changing it.
+        DROP TRIGGER IF EXISTS images_update_image_features;
+        CREATE TRIGGER IF NOT EXISTS images_move_image_features AFTER UPDATE OF file_name ON images
+        BEGIN
+            DELETE FROM image_features WHERE file_name IN (OLD.file_name, NEW.file_name);
+        END;
+
+        -- Shared dictionaries of the compact metadata encoding, see metadata_codec. The newest encodes new rows.
+        CREATE TABLE IF NOT EXISTS metadata_dictionaries
+        (
+            id INTEGER PRIMARY KEY,
+            dictionary BLOB NOT NULL
+        );
+
+        -- Groups of similar dhash found by the cluster command
+        CREATE TABLE IF NOT EXISTS duplicate_groups 
+        (
+            dhash BLOB PRIMARY KEY,
+            group_dhash BLOB NOT NULL
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_group_dhash ON duplicate_groups 
+        (
+            group_dhash
+        );
+
+        -- Groups of similar dhash found by browse --max-distance when it starts, same columns as duplicate_groups
+        CREATE TABLE IF NOT EXISTS similar_groups 
+        (
+            dhash BLOB PRIMARY KEY,
+            group_dhash BLOB NOT NULL
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_similar_group_dhash ON similar_groups 
+        (
+            group_dhash
+        );
+
         ''')
-        self._db_cur.row_factory = sqlite3.Row
+        self._load_dictionaries()
+        if not self._table_exists('dhash_groups'):
+            self._create_dhash_groups()
+        self._db_cur.executescript(r'''
+        -- Keep dhash_groups up to date
+        CREATE TRIGGER IF NOT EXISTS images_insert_dhash_groups AFTER INSERT ON images 
+        WHEN NEW.dhash IS NOT NULL
+        BEGIN
+            INSERT INTO dhash_groups (dhash, count, ignored) 
+            VALUES (NEW.dhash, 1, EXISTS (SELECT 1 FROM ignore WHERE dhash = NEW.dhash))
+            ON CONFLICT (dhash) DO UPDATE SET count = count + 1;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS images_delete_dhash_groups AFTER DELETE ON images 
+        WHEN OLD.dhash IS NOT NULL
+        BEGIN
+            UPDATE dhash_groups SET count = count - 1 WHERE dhash = OLD.dhash;
+            DELETE FROM dhash_groups WHERE dhash = OLD.dhash AND count <= 0;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS images_update_dhash_groups AFTER UPDATE OF dhash ON images 
+        WHEN OLD.dhash IS NOT NEW.dhash
+        BEGIN
+            UPDATE dhash_groups SET count = count - 1 WHERE dhash = OLD.dhash;
+            DELETE FROM dhash_groups WHERE dhash = OLD.dhash AND count <= 0;
+            INSERT INTO dhash_groups (dhash, count, ignored) 
+            SELECT NEW.dhash, 1, EXISTS (SELECT 1 FROM ignore WHERE dhash = NEW.dhash) 
+            WHERE NEW.dhash IS NOT NULL
+            ON CONFLICT (dhash) DO UPDATE SET count = count + 1;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS ignore_insert_dhash_groups AFTER INSERT ON ignore
+        BEGIN
+            UPDATE dhash_groups SET ignored = 1 WHERE dhash = NEW.dhash;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS ignore_delete_dhash_groups AFTER DELETE ON ignore
+        BEGIN
+            UPDATE dhash_groups SET ignored = 0 WHERE dhash = OLD.dhash;
+        END;
+
+        ''')
+        if not self._table_exists('deleted'):
+            self._create_deleted()
+        # Columns added after the first release
+        self._add_column('images', 'fingerprint', 'BLOB')
+        self._add_columns('images', {'directory': 'TEXT', 'stem': 'TEXT'}, self._fill_directory_stem)
+        # No type so numbers and text are stored as they are in metadata
+        self._add_columns('images', {column: '' for column in TAG_COLUMNS}, self._fill_tags)
+        for column in TAG_COLUMNS:
+            self._execute(f'''
+                CREATE INDEX IF NOT EXISTS idx_{column} ON images 
+                (
+                    {column}
+                )
+            ''')
+        self._db_cur.executescript(r'''
+        CREATE INDEX IF NOT EXISTS idx_fingerprint ON images 
+        (
+            fingerprint
+        );
+
+        -- Files with the same name but another extension, ie. live photos or RAW+JPEG
+        CREATE INDEX IF NOT EXISTS idx_directory_stem ON images 
+        (
+            directory,
+            stem
+        );
+        ''')
+        # Multi-index hashing of dhash for image_select_similar_dhash()
+        for block in range(DHASH_BLOCKS):
+            self._execute(f'''
+                CREATE INDEX IF NOT EXISTS idx_dhash_block{block} ON images 
+                (
+                    {block_expression(block)}
+                )
+            ''')
+        self._db_cur.row_factory = self._row_factory
+
+    def _load_dictionaries(self):
+        self._dictionaries = dict(self._db_connection.execute(r'''
+            SELECT id, dictionary FROM metadata_dictionaries
+        '''))
+        self._dictionary_id = max(self._dictionaries, default=None)
+
+    def _encode_metadata(self, metadata):
+        # JSON text, or the compact encoding once metadata_compact() has made a dictionary
+        if self._dictionary_id is None:
+            return json.dumps(metadata)
+        return metadata_codec.encode(metadata, self._dictionary_id, self._dictionaries[self._dictionary_id])
+
+    def _decode_metadata(self, metadata):
+        # JSON text of metadata in either encoding
+        if isinstance(metadata, bytes):
+            if metadata_codec.dictionary_id(metadata) not in self._dictionaries:
+                # Made by metadata_compact() since the database was opened
+                self._load_dictionaries()
+            return metadata_codec.decode(metadata, self._dictionaries)
+        return metadata
+
+    def _row_factory(self, cursor, row):
+        # Rows have the JSON text of metadata whatever the encoding so callers don't need to know about it
+        for i, column in enumerate(cursor.description):
+            if column[0] == 'metadata' and isinstance(row[i], bytes):
+                row = row[:i] + (self._decode_metadata(row[i]),) + row[i + 1:]
+        return sqlite3.Row(cursor, row)
+
+    def _table_exists(self, table):
+        return self._execute(r'''
+            SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?
+        ''', (table,)).fetchone() is not None
+
+    def _create_dhash_groups(self):
+        # Number of images of each dhash, kept up to date by the triggers of _init_db(). Created together with the rows
+        # of an existing database so an interrupted fill is tried again on the next open.
+        with self._db_connection:
+            self._execute('BEGIN IMMEDIATE')
+            if self._table_exists('dhash_groups'):
+                return
+            self._execute(r'''
+                CREATE TABLE dhash_groups 
+                (
+                    dhash BLOB PRIMARY KEY,
+                    count INT NOT NULL,
+                    ignored INT NOT NULL
+                )
+            ''')
+            self._execute(r'''
+                CREATE INDEX idx_dhash_groups_duplicates ON dhash_groups 
+                (
+                    dhash
+                ) 
+                WHERE count > 1 AND ignored = 0
+            ''')
+            self._execute(r'''
+                INSERT INTO dhash_groups (dhash, count, ignored)
+                SELECT dhash, count(*), dhash IN (SELECT dhash FROM ignore)
+                FROM images
+                WHERE dhash IS NOT NULL
+                GROUP BY dhash
+            ''')
+
+    def _create_deleted(self):
+        # Deletions used to be logged to a JSON file each in cache_dir. The table is created together with the rows of
+        # the files so an interrupted import is tried again on the next open. The files are left in place.
+        rows = []
+        for file in self._cache_dir.glob('img*.json'):
+            try:
+                with file.open() as f:
+                    dhash, metadata = json.load(f)
+                if not isinstance(metadata, dict):
+                    raise ValueError("metadata is not an object")
+                rows.append((bytes.fromhex(dhash), self._encode_metadata(metadata)))
+            except (OSError, ValueError, TypeError) as e:
+                print(f"# WARNING skipping deletion log {file} # {e}")
+        with self._db_connection:
+            # DDL doesn't start a transaction by itself. Take the write lock first as another process may be creating the
+            # table too.
+            self._execute('BEGIN IMMEDIATE')
+            if self._table_exists('deleted'):
+                return
+            self._execute(r'''
+                -- Images deleted by browse, the training data of the predictor
+                CREATE TABLE deleted 
+                (
+                    id INTEGER PRIMARY KEY,
+                    dhash BLOB NOT NULL,
+                    metadata TEXT NOT NULL
+                )
+            ''')
+            self._execute(r'''
+                CREATE INDEX idx_deleted_dhash ON deleted 
+                (
+                    dhash
+                )
+            ''')
+            self._db_cur.executemany(r'''
+                INSERT INTO deleted (dhash, metadata) 
+                VALUES (?, ?)
+            ''', rows)
+
+    def _fill_tags(self):
+        # Before the row factory is set, so metadata may still be encoded
+        for rows in self._select_chunks('images', 'metadata'):
+            self._db_cur.executemany(f'''
+                UPDATE images SET {', '.join(f'{column} = ?' for column in TAG_COLUMNS)} WHERE rowid = ?
+            ''', ((*_tag_values(json.loads(self._decode_metadata(metadata))), rowid) for rowid, metadata in rows))
+
+    def _select_chunks(self, table, *columns):
+        # Yields lists of (rowid, *columns) of all rows of table, CHUNK_ROWS at a time so the whole table isn't read
+        # into memory
+        start = -2 ** 63
+        while rows := self._select_chunk(table, start, *columns):
+            yield rows
+            start = rows[-1][0] + 1
+
+    def _select_chunk(self, table, start, *columns):
+        # Up to CHUNK_ROWS (rowid, *columns) from rowid start in rowid order, found with the rowid index
+        return self._execute(f'''
+            SELECT rowid, {', '.join(columns)} FROM {table} WHERE rowid >= ? ORDER BY rowid LIMIT ?
+        ''', (start, CHUNK_ROWS)).fetchall()
+
+    def _columns(self, table):
+        return [row[1] for row in self._execute(f'PRAGMA table_info({table})')]
+
+    def _add_column(self, table, column, definition):
+        # Returns True if the column was added
+        if column not in self._columns(table):
+            self._execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+            return True
+        return False
+
+    def _add_columns(self, table, definitions, fill):
+        # Adds the columns of definitions, {column: definition}, that table doesn't have and calls fill() to set them
+        # for existing rows. ALTER TABLE commits on its own, so both are done in one transaction, otherwise columns
+        # added by an interrupted open would never be filled.
+        if set(definitions) <= set(self._columns(table)):
+            return
+        with self._db_connection:
+            self._execute('BEGIN IMMEDIATE')
+            # Again, another connection may have added them meanwhile
+            columns = self._columns(table)
+            added = [column for column in definitions if column not in columns]
+            for column in added:
+                self._execute(f'ALTER TABLE {table} ADD COLUMN {column} {definitions[column]}')
+            if added:
+                fill()
+
+    def _fill_directory_stem(self):
+        for rows in self._select_chunks('images', 'file_name'):
+            self._db_cur.executemany(r'''
+                UPDATE images SET directory = ?, stem = ? WHERE rowid = ?
+            ''', ((*_directory_stem(file_name), rowid) for rowid, file_name in rows))
 
     def image_insert_or_replace(self, **kwargs):
-        kwargs['metadata'] = json.dumps(kwargs['metadata'])
+        # Rows are buffered and only visible to queries after the next flush()
+        kwargs.update(zip(TAG_COLUMNS, _tag_values(kwargs['metadata'])))
+        kwargs['metadata'] = self._encode_metadata(kwargs['metadata'])
         kwargs['file_name'] = str(kwargs['file_name'])
-        self._execute(r'''
-            INSERT OR REPLACE INTO images (file_name, mtime, size, dhash, metadata) 
-            VALUES (:file_name, :mtime, :size, :dhash, :metadata)
-        ''', kwargs)
-        self._execute(r'''
-            DELETE FROM ignore WHERE dhash = :dhash
-        ''', kwargs)
-        self._commit()
+        kwargs['directory'], kwargs['stem'] = _directory_stem(kwargs['file_name'])
+        kwargs.setdefault('fingerprint', None)
+        kwargs.setdefault('features', None)
+        self._image_buffer.append(kwargs)
+        if len(self._image_buffer) >= FLUSH_ROWS or time.monotonic() - self._last_flush >= FLUSH_SECONDS:
+            self.flush()
+
+    def flush(self):
+        if self._image_buffer:
+            # One transaction for the whole buffer, rolled back on error
+            with self._db_connection:
+                columns = ['file_name', 'mtime', 'size', 'dhash', 'metadata', 'fingerprint', 'directory', 'stem'] + TAG_COLUMNS
+                self._db_cur.executemany(f'''
+                    INSERT OR REPLACE INTO images ({', '.join(columns)}) 
+                    VALUES ({', '.join(f':{column}' for column in columns)})
+                ''', self._image_buffer)
+                self._db_cur.executemany(r'''
+                    DELETE FROM ignore WHERE dhash = :dhash
+                ''', self._image_buffer)
+                self._db_cur.executemany(r'''
+                    INSERT OR REPLACE INTO image_features (file_name, version, indices, data) 
+                    VALUES (?, ?, ?, ?)
+                ''', (
+                    (row['file_name'], *row['features']) 
+                    for row in self._image_buffer 
+                    if row['features']
+                ))
+            self._image_buffer = []
+        self._last_flush = time.monotonic()
 
     def image_select_by_dhash(self, dhash):
         return self._execute(r'''
@@ -82,43 +456,384 @@ class DB(object):
             'size': size,
         }).fetchone()
 
+    def image_select_by_file_names(self, file_names):
+        # Rows of those of file_names that are in the database, found with one query
+        file_names = [str(file_name) for file_name in file_names]
+        if not file_names:
+            return []
+        return self._execute(fr'''
+            SELECT file_name, mtime, size, metadata
+            FROM images
+            WHERE file_name IN ({', '.join(['?'] * len(file_names))})
+        ''', file_names).fetchall()
+
+    def image_select_tags(self, random=False, limit=None, hashed=False, **tags):
+        # Images whose hot tags equal the keyword arguments, or don't have the tag if the argument is None, found with 
+        # the tag indexes. ie. image_select_tags(Keywords=None, random=True, limit=10). Only images with a dhash if
+        # hashed is set.
+        conditions = ['dhash IS NOT NULL'] if hashed else []
+        params = []
+        for tag, value in tags.items():
+            if tag not in HOT_TAGS:
+                raise ValueError(f"{tag} is not one of {HOT_TAGS}")
+            if value is None:
+                conditions.append(f'tag_{tag} IS NULL')
+            else:
+                conditions.append(f'tag_{tag} = ?')
+                params.append(json.dumps(value) if isinstance(value, list) else value)
+        sql = 'SELECT * FROM images'
+        if conditions:
+            sql += f' WHERE {" AND ".join(conditions)}'
+        if random:
+            sql += ' ORDER BY RANDOM()'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        return self._execute(sql, params)
+
+    def image_select_stats(self, root):
+        return self._execute(fr'''
+            SELECT file_name, mtime, size
+            FROM images
+            WHERE {BELOW_ROOT}
+        ''', _below_params(root))
+
+    def image_select_hashed(self, root, duplicates=False):
+        # Images below root, only those in a group of duplicates if duplicates is set
+        condition = 'dhash IN (SELECT dhash FROM dhash_groups WHERE count > 1 AND ignored = 0)' if duplicates else '1'
+        return self._execute(fr'''
+            SELECT file_name
+            FROM images
+            WHERE {BELOW_ROOT} AND dhash IS NOT NULL AND {condition}
+        ''', _below_params(root))
+
+    def image_select_missing_fingerprint(self, root):
+        return self._execute(fr'''
+            SELECT file_name
+            FROM images
+            WHERE {BELOW_ROOT} AND fingerprint IS NULL
+        ''', _below_params(root))
+
+    def image_select_siblings(self, file_names):
+        # file_name of files in the same directory with the same name before the extension as any of file_names,
+        # including themselves
+        keys = [key for file_name in file_names for key in _directory_stem(file_name)]
+        if not keys:
+            return []
+        return self._execute(fr'''
+            SELECT file_name, directory, stem
+            FROM images
+            WHERE (directory, stem) IN (VALUES {', '.join(['(?, ?)'] * (len(keys) // 2))})
+        ''', keys).fetchall()
+
+    def image_select_by_fingerprint(self, fingerprint):
+        return self._execute(r'''
+            SELECT * FROM images WHERE fingerprint = ?
+        ''', (fingerprint,)).fetchall()
+
     def image_select_duplicate_dhash(self, start='', limit=10):
         return self._execute(r'''
-            SELECT *
+            SELECT images.*
             FROM images
             INNER JOIN (
                 SELECT dhash
-                FROM images 
+                FROM dhash_groups 
                 WHERE 
-                    dhash > ? AND
-                    dhash NOT IN (SELECT dhash FROM ignore)
-                GROUP BY dhash 
-                HAVING count(dhash) > 1
+                    count > 1 AND
+                    ignored = 0 AND
+                    dhash > ?
                 ORDER BY dhash
                 LIMIT ?
                 ) dups ON images.dhash = dups.dhash
-            ORDER BY dhash;
+            ORDER BY images.dhash;
         ''', (start, limit))
 
-    def image_delete(self, file_name):
+    def dhash_groups_progress(self, dhash):
+        # Returns (number of duplicate groups up to dhash, total number of duplicate groups)
+        return tuple(self._execute(r'''
+            SELECT 
+                coalesce(sum(dhash <= ?), 0),
+                count(*)
+            FROM dhash_groups
+            WHERE count > 1 AND ignored = 0
+        ''', (dhash,)).fetchone())
+
+    def image_select_similar_dhash(self, dhash, max_distance):
+        # Rows with a dhash at most max_distance bits from dhash, max_distance can't be more than MAX_DISTANCE
+        rows = self._execute(f'''
+            SELECT * FROM images WHERE rowid IN ({self._similar_dhash_query()}) ORDER BY dhash, file_name
+        ''', dhash_blocks(dhash)).fetchall()
+        return [row for row in rows if hamming_distance(row['dhash'], dhash) <= max_distance]
+
+    def image_select_last_rowid(self):
+        return self._execute(r'''
+            SELECT coalesce(max(rowid), 0) FROM images
+        ''').fetchone()[0]
+
+    def similar_groups_extend(self, after_rowid, max_distance):
+        # Adds the dhash of images inserted after the rowid after_rowid, ie. by a scan running since browse grouped
+        # hashes, to similar_groups. Each joins, and merges, the groups of the hashes at most max_distance bits away,
+        # found with the block indexes. Returns the rowid to pass the next time.
+        self.flush()
+        last_rowid = self.image_select_last_rowid()
+        hashes = [row['dhash'] for row in self._execute(r'''
+            SELECT DISTINCT dhash FROM images WHERE rowid > ? AND rowid <= ? AND length(dhash) = ?
+        ''', (after_rowid, last_rowid, DHASH_BYTES))]
+        with self._db_connection:
+            for dhash in hashes:
+                if self._execute('SELECT 1 FROM similar_groups WHERE dhash = ?', (dhash,)).fetchone():
+                    continue
+                # Hashes without a group have no other similar hash, so the groups of these are all that is connected
+                similar = {dhash} | {row['dhash'] for row in self.image_select_similar_dhash(dhash, max_distance)}
+                groups = {row['group_dhash'] for row in self._execute(f'''
+                    SELECT group_dhash FROM similar_groups WHERE dhash IN ({', '.join(['?'] * len(similar))})
+                ''', list(similar))}
+                group_dhash = min(groups or similar)
+                self._db_cur.executemany(r'''
+                    UPDATE similar_groups SET group_dhash = ? WHERE group_dhash = ?
+                ''', ((group_dhash, group) for group in groups if group != group_dhash))
+                self._db_cur.executemany(r'''
+                    INSERT OR REPLACE INTO similar_groups (dhash, group_dhash)
+                    VALUES (?, ?)
+                ''', ((similar_dhash, group_dhash) for similar_dhash in similar))
+        return last_rowid
+
+    @staticmethod
+    def _similar_dhash_query():
+        # rowid of images sharing at least one block with a dhash, using the block indexes. Any dhash within 
+        # MAX_DISTANCE bits is among them.
+        return '\nUNION\n'.join(
+            f'SELECT rowid FROM images WHERE {block_expression(block)} = ?'
+            for block in range(DHASH_BLOCKS)
+        )
+
+    def image_select_cluster_groups(self, start, limit=10, table='duplicate_groups'):
+        # Returns [(group_dhash, rows)] of groups from the cluster command, or browse with similar_groups for table, 
+        # with more than one image in order of group_dhash
+        assert table in GROUP_TABLES
+        rows = self._execute(fr'''
+            SELECT images.*, clusters.group_dhash
+            FROM images
+            INNER JOIN {table} groups ON images.dhash = groups.dhash
+            INNER JOIN (
+                -- A group is hidden once any of its hashes is ignored
+                SELECT group_dhash
+                FROM {table} groups
+                INNER JOIN dhash_groups ON dhash_groups.dhash = groups.dhash
+                WHERE group_dhash > ?
+                GROUP BY group_dhash
+                HAVING sum(dhash_groups.count) > 1 AND max(dhash_groups.ignored) = 0
+                ORDER BY group_dhash
+                LIMIT ?
+                ) clusters ON groups.group_dhash = clusters.group_dhash
+            ORDER BY clusters.group_dhash, images.dhash, images.file_name
+        ''', (start, limit)).fetchall()
+        return [(dhash, list(group)) for dhash, group in groupby(rows, lambda row: row['group_dhash'])]
+
+    def dhash_select_clusters(self):
+        # Every distinct dhash in order with its number of images and group_dhash from the last cluster command, or None
+        return self._execute(r'''
+            SELECT hashes.dhash, hashes.count, duplicate_groups.group_dhash
+            FROM dhash_groups hashes
+            LEFT JOIN duplicate_groups ON hashes.dhash = duplicate_groups.dhash
+            ORDER BY hashes.dhash
+        ''').fetchall()
+
+    def duplicate_groups_select_broken(self):
+        # group_dhash of groups with a dhash that no longer has images. The rest of such a group may no longer be
+        # connected and has to be clustered again.
+        return {
+            row['group_dhash']
+            for row in self._execute(r'''
+                SELECT DISTINCT group_dhash
+                FROM duplicate_groups
+                WHERE dhash NOT IN (SELECT dhash FROM dhash_groups)
+            ''')
+        }
+
+    def duplicate_groups_update(self, groups, clear=False, table='duplicate_groups'):
+        # groups is an iterable of (dhash, group_dhash). Without clear only the given rows are replaced and rows of 
+        # dhash no longer in images are removed.
+        assert table in GROUP_TABLES
+        self.flush()
+        with self._db_connection:
+            if clear:
+                self._execute(f'''
+                    DELETE FROM {table}
+                ''')
+            else:
+                self._execute(f'''
+                    DELETE FROM {table} 
+                    WHERE dhash NOT IN (SELECT dhash FROM dhash_groups)
+                ''')
+            self._db_cur.executemany(f'''
+                INSERT OR REPLACE INTO {table} (dhash, group_dhash) 
+                VALUES (?, ?)
+            ''', groups)
+
+    def image_delete(self, file_name, log=False):
+        # With log the row is also recorded in deleted
+        self.flush()
         file_name = str(file_name)
-        self._execute(r'''
-            DELETE FROM images WHERE file_name = ?
-        ''', (file_name,))
-        self._commit()
+        with self._db_connection:
+            if log:
+                self._execute(r'''
+                    INSERT INTO deleted (dhash, metadata)
+                    SELECT dhash, metadata FROM images WHERE file_name = ?
+                ''', (file_name,))
+            self._execute(r'''
+                DELETE FROM images WHERE file_name = ?
+            ''', (file_name,))
+
+    def deleted_select(self):
+        return self._execute(r'''
+            SELECT dhash, metadata FROM deleted
+        ''')
+
+    def image_select_deleted_dhash(self):
+        # Images with the dhash of a deleted image and their features if stored
+        return self._execute(r'''
+            SELECT images.file_name, dhash, metadata, version, indices, data
+            FROM images 
+            LEFT JOIN image_features ON images.file_name = image_features.file_name
+            WHERE dhash IN (SELECT dhash FROM deleted)
+        ''')
+
+    def image_features_select(self, file_names):
+        self.flush()
+        file_names = [str(file_name) for file_name in file_names]
+        return self._execute(fr'''
+            SELECT * FROM image_features WHERE file_name IN ({', '.join('?' * len(file_names))})
+        ''', file_names).fetchall()
+
+    def image_features_update(self, features):
+        # features is an iterable of (file_name, version, indices, data), rows of files not in images are skipped
+        self.flush()
+        with self._db_connection:
+            self._db_cur.executemany(r'''
+                INSERT OR REPLACE INTO image_features (file_name, version, indices, data) 
+                SELECT ?, ?, ?, ?
+                WHERE EXISTS (SELECT 1 FROM images WHERE file_name = ?)
+            ''', (
+                (str(file_name), version, indices, data, str(file_name))
+                for file_name, version, indices, data in features
+            ))
+
+    def deleted_select_version(self):
+        # Changes whenever a row is added to deleted
+        return tuple(self._execute(r'''
+            SELECT count(*), coalesce(max(id), 0) FROM deleted
+        ''').fetchone())
+
+    def image_delete_many(self, file_names):
+        self.flush()
+        with self._db_connection:
+            self._db_cur.executemany(r'''
+                DELETE FROM images WHERE file_name = ?
+            ''', ((str(file_name),) for file_name in file_names))
 
     def image_purge(self, condition):
-        cursor2 = self._db_connection.cursor()
-        for row in self._execute(r'''
-                SELECT * FROM images
-                '''):
-            if condition(row):
-                cursor2.execute(r'''
-                    DELETE FROM images WHERE file_name = ?
-                ''', (row['file_name'],))
-        self._commit()
+        self.flush()
+        rows = self._execute(r'''
+                SELECT file_name FROM images
+                ''').fetchall()
+        self.image_delete_many(row['file_name'] for row in rows if condition(row))
+
+    def image_purge_unseen(self, root, seen):
+        # Delete rows below root whose file_name is not in the set seen. Returns the deleted file names.
+        missing = [
+            row['file_name']
+            for row in self._execute(fr'''
+                SELECT file_name
+                FROM images
+                WHERE {BELOW_ROOT}
+            ''', _below_params(root))
+            if row['file_name'] not in seen
+        ]
+        self.image_delete_many(missing)
+        return missing
+
+    def image_move(self, file_name, new_file_name, mtime, metadata):
+        # Point the row of file_name at new_file_name keeping its dhash
+        self.flush()
+        with self._db_connection:
+            self._execute(r'''
+                DELETE FROM images WHERE file_name = ?
+            ''', (str(new_file_name),))
+            directory, stem = _directory_stem(new_file_name)
+            self._execute(r'''
+                UPDATE images 
+                SET file_name = :new_file_name, mtime = :mtime, metadata = :metadata, directory = :directory, stem = :stem
+                WHERE file_name = :file_name
+            ''', {
+                'file_name': str(file_name),
+                'new_file_name': str(new_file_name),
+                'mtime': mtime,
+                'metadata': self._encode_metadata(metadata),
+                'directory': directory,
+                'stem': stem,
+            })
+
+    def metadata_compact(self, sample_size):
+        # Encode the metadata of every row with a new dictionary built from sample_size random images. Returns the
+        # number of rows encoded.
+        self.flush()
+        with self._db_connection:
+            self._execute(r'''
+                INSERT INTO metadata_dictionaries (dictionary)
+                VALUES (?)
+            ''', (metadata_codec.build_dictionary(self._sample_metadata(sample_size)),))
+        self._load_dictionaries()
+        count = 0
+        for table in ['images', 'deleted']:
+            start = -2 ** 63
+            while True:
+                # A transaction for each chunk so other connections, ie. browse, can write in between. Each row is
+                # read in the same transaction it is written so changes made in between aren't lost.
+                with self._db_connection:
+                    self._execute('BEGIN IMMEDIATE')
+                    rows = self._select_chunk(table, start, 'metadata')
+                    self._db_cur.executemany(f'''
+                        UPDATE {table} SET metadata = ? WHERE rowid = ?
+                    ''', ((self._encode_metadata(json.loads(metadata)), rowid) for rowid, metadata in rows))
+                if not rows:
+                    break
+                count += len(rows)
+                start = rows[-1][0] + 1
+        # Older dictionaries are kept for rows written by scan or browse started before this
+        return count
+
+    def _sample_metadata(self, sample_size):
+        # Metadata of up to sample_size images at random rowids, each found with the rowid index instead of sorting
+        # the whole table
+        first, last = self._execute(r'''
+            SELECT min(rowid), max(rowid) FROM images
+        ''').fetchone()
+        if first is None:
+            return []
+        samples = {}
+        for _ in range(sample_size):
+            rowid, metadata = self._execute(r'''
+                SELECT rowid, metadata FROM images WHERE rowid >= ? ORDER BY rowid LIMIT 1
+            ''', (random.randint(first, last),)).fetchone()
+            samples[rowid] = metadata
+        return [json.loads(metadata) for metadata in samples.values()]
+
+    def vacuum(self):
+        # Return free pages, ie. left by metadata_compact(), to the file system
+        self.flush()
+        self._db_connection.execute('VACUUM')
+
+    def image_update_fingerprints(self, fingerprints):
+        # fingerprints is an iterable of (file_name, fingerprint)
+        self.flush()
+        with self._db_connection:
+            self._db_cur.executemany(r'''
+                UPDATE images SET fingerprint = ? WHERE file_name = ?
+            ''', ((fingerprint, str(file_name)) for file_name, fingerprint in fingerprints))
 
     def ignore_insert_dhash(self, dhash):
+        self.flush()
         self._execute(r'''
             INSERT OR IGNORE INTO ignore (dhash) 
             VALUES (?)
@@ -1,5 +1,29 @@
+import queue
+import threading
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from datetime import datetime
+
 from exiftool import ExifTool, fsencode
 
+from file_utils import batched
+
+# Maximum number of files sent to exiftool in one invocation
+BATCH_SIZE = 200
+
+
+def relocate_metadata(metadata, file, mtime):
+    # Update the file system tags of metadata read from another path, ie. after the file was moved
+    metadata = dict(metadata)
+    metadata['SourceFile'] = str(file)
+    metadata['FileName'] = file.name
+    metadata['Directory'] = str(file.parent)
+    if 'FileModifyDate' in metadata:
+        # Same format as exiftool, ie. 2020:01:31 12:00:00+09:00
+        date = datetime.fromtimestamp(mtime).astimezone().strftime('%Y:%m:%d %H:%M:%S%z')
+        metadata['FileModifyDate'] = f'{date[:-2]}:{date[-2:]}'
+    return metadata
+
 
 class ExifError(Exception):
     pass
@@ -22,12 +46,90 @@ class Exif(ExifTool):
                 d[k.split(':')[-1]] = d.pop(k)
         return json
 
+    def get_preview(self, filename, tag='PreviewImage'):
+        # Embedded image in tag as bytes, empty if there is none
+        return super().execute(b'-b', fsencode(f'-{tag}'), fsencode(str(filename)))
+
     def get_metadata(self, filename):
-        metadata = super().get_metadata(str(filename))
+        metadata = self.get_metadata_batch([filename])[0]
+        if isinstance(metadata, Exception):
+            raise metadata
+        return metadata
+
+    def get_metadata_batch(self, filenames):
+        # Returns metadata in the same order as filenames. Files that could not be read are returned as an 
+        # ExifError, UnsupportedMIMETypeException or the exception of exiftool instead of raising so one bad file
+        # doesn't fail the batch
+        filenames = [str(filename) for filename in filenames]
+        if not filenames:
+            return []
+
+        try:
+            batch = super().get_metadata_batch(filenames)
+        except Exception as e:
+            if len(filenames) == 1:
+                return [e]
+            # ie. a file that makes exiftool fail or print invalid JSON, read one at a time so only that file fails
+            return [metadata for filename in filenames for metadata in self.get_metadata_batch([filename])]
+
+        # exiftool skips files it can't find so match results on SourceFile rather than position
+        results = defaultdict(deque)
+        for metadata in batch:
+            results[metadata['SourceFile']].append(metadata)
+
+        return [
+            self._check_metadata(results[filename].popleft()) if results[filename] else ExifError('File not found')
+            for filename in filenames
+        ]
+
+    def iter_metadata(self, files, batch_size=BATCH_SIZE):
+        # Yields (file, metadata) for an iterable of files, calling exiftool once per batch
+        for batch in batched(files, batch_size):
+            yield from zip(batch, self.get_metadata_batch(batch))
+
+    @staticmethod
+    def _check_metadata(metadata):
         if 'Error' in metadata:
-            raise ExifError(metadata['Error'])
+            return ExifError(metadata['Error'])
 
         mime_type = metadata['MIMEType']
         if not (mime_type.startswith('image/') or mime_type.startswith('video/')):
-            raise UnsupportedMIMETypeException(mime_type)
+            return UnsupportedMIMETypeException(mime_type)
         return metadata
+
+
+class ExifPool(object):
+    # Up to size long-lived exiftool processes shared by threads, started when first needed
+
+    def __init__(self, size):
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def get(self):
+        # Waits for a process that no other thread is using
+        with self._slots:
+            try:
+                et = self._idle.get_nowait()
+            except queue.Empty:
+                et = Exif()
+                et.start()
+            try:
+                yield et
+            except BaseException:
+                # The process may be left in the middle of a command, ie. after a timeout, so it is not used again
+                # and another one is started on the next get()
+                try:
+                    et.terminate()
+                except OSError:
+                    pass
+                raise
+            if et.running:
+                self._idle.put(et)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().terminate()
+            except queue.Empty:
+                break
@@ -1,17 +1,77 @@
+import hashlib
+import os
 import shlex
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+from itertools import islice
 from pathlib import Path
 
-def path_file_walk(path):
-    from shashin import SKIP_DIRS
+def path_stat_walk(path, skip_dirs=(), threads=1):
+    # Yields (file, stat) for path or every file below it in sorted order, reusing the stat from os.scandir().
+    # Directories with a name matching one of the fnmatch patterns in skip_dirs are not entered. Subdirectories are
+    # listed ahead in a pool of threads to hide the latency of network filesystems.
     if path.is_file():
-        yield path
-    else:
-        for child in sorted(path.iterdir()):
-            if child.is_file():
-                yield child
-            elif child.is_dir():
-                if child.name not in SKIP_DIRS:
-                    yield from path_file_walk(child)
+        yield path, path.stat()
+        return
+    with ThreadPoolExecutor(threads) as executor:
+        yield from _walk(executor, executor.submit(_list_dir, path, skip_dirs), skip_dirs)
+
+
+def _walk(executor, listing, skip_dirs):
+    children = listing.result()
+    # Start listing the subdirectories before yielding any files of this one
+    listings = {
+        child: executor.submit(_list_dir, child, skip_dirs)
+        for child, stat in children
+        if stat is None
+    }
+    for child, stat in children:
+        if stat is None:
+            yield from _walk(executor, listings[child], skip_dirs)
+        else:
+            yield child, stat
+
+
+def _list_dir(path, skip_dirs):
+    # Returns sorted (file, stat) of files and (directory, None) of directories to walk
+    children = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_file():
+                    children.append((Path(entry.path), entry.stat()))
+                elif entry.is_dir() and not any(fnmatch(entry.name, pattern) for pattern in skip_dirs):
+                    children.append((Path(entry.path), None))
+            except OSError:
+                # File was removed after listing
+                continue
+    return sorted(children, key=lambda child: child[0])
+
+
+# Bytes read from the head and from the tail of a file for its fingerprint
+FINGERPRINT_CHUNK = 16 * 1024
+
+
+def file_fingerprint(path, size):
+    # Quick fingerprint from the size, head and tail of a file. Files with different fingerprints differ, files with
+    # the same fingerprint are only candidates for being identical and have to be compared in full to be sure.
+    fingerprint = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(path, 'rb') as f:
+        fingerprint.update(f.read(FINGERPRINT_CHUNK))
+        if size > FINGERPRINT_CHUNK:
+            f.seek(max(size - FINGERPRINT_CHUNK, FINGERPRINT_CHUNK))
+            fingerprint.update(f.read(FINGERPRINT_CHUNK))
+    return fingerprint.digest()
+
+
+def batched(iterable, size):
+    # Split iterable into lists of at most size items
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
 
 
 def is_child(parent, child):
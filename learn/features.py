@@ -0,0 +1,68 @@
+import re
+from datetime import datetime
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.feature_extraction import FeatureHasher
+
+# Increment when image_features() changes so stored vectors are computed again
+FEATURE_VERSION = 1
+N_FEATURES = 2 ** 16
+
+DATE_FORMAT = '%Y:%m:%d %H:%M:%S'
+DATE_LENGTH = len('0000:00:00 00:00:00')
+EPOCH = datetime(1970, 1, 1)
+# Tokens of CountVectorizer
+TOKEN_PATTERN = re.compile(r'(?u)\b\w\w+\b')
+
+_hasher = FeatureHasher(N_FEATURES, input_type='dict', alternate_sign=False)
+
+
+def image_features(metadata):
+    # Numeric tags, dates and the length and words of text tags of one image
+    features = {}
+    for key, value in metadata.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            features[f'num {key}'] = value
+            continue
+        value = str(value)
+        features[f'len {key}'] = len(value)
+        for token in TOKEN_PATTERN.findall(value.lower()):
+            features[f'token {token}'] = features.get(f'token {token}', 0) + 1
+        if 'Date' in key:
+            try:
+                features[f'date {key}'] = (datetime.strptime(value[:DATE_LENGTH], DATE_FORMAT) - EPOCH).total_seconds()
+            except ValueError:
+                pass
+    return features
+
+
+def pack_features(features):
+    # Returns (FEATURE_VERSION, indices, data) of the hashed vector of features for storing in the database
+    vector = _hasher.transform([features])
+    return (
+        FEATURE_VERSION,
+        vector.indices.astype(np.int32).tobytes(),
+        vector.data.astype(np.float64).tobytes(),
+    )
+
+
+def unpack_features(packed):
+    # Sparse matrix with a row for each (indices, data) from pack_features()
+    indices = [np.frombuffer(row_indices, dtype=np.int32) for row_indices, _ in packed]
+    data = [np.frombuffer(row_data, dtype=np.float64) for _, row_data in packed]
+    indptr = np.concatenate([[0], np.cumsum([len(row_indices) for row_indices in indices])])
+    return csr_matrix(
+        (
+            np.concatenate(data) if data else np.empty(0),
+            np.concatenate(indices) if indices else np.empty(0, dtype=np.int32),
+            indptr
+        ),
+        shape=(len(packed), N_FEATURES)
+    )
+
+
+def pair_features(vectors, left, right):
+    # Sign of the difference of each feature between the rows left and right of vectors. Features missing from one
+    # image count as 0.
+    return (vectors[left] - vectors[right]).sign()
@@ -0,0 +1,179 @@
+import io
+
+import numpy as np
+import pandas as pd
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.pipeline import FeatureUnion, Pipeline
+from sklearn.preprocessing import FunctionTransformer
+
+from .utils import split
+
+# Pandas pipeline on the joined metadata of pairs of images used before learn.features. Models fitted with it are no
+# longer loaded, it is kept to compare the ranking quality of both with train --compare.
+
+# Training pairs of deleted and kept images sampled from each dhash
+MAX_PAIRS_PER_DHASH = 1000
+
+
+class BaseReindexTransformer(BaseEstimator, TransformerMixin):
+    def __sklearn_is_fitted__(self):
+        # Newer scikit-learn checks every step is fitted before transform
+        return hasattr(self, 'columns')
+
+    def transform(self, X, y=None):
+        return X.reindex(columns=self.columns)
+
+
+class NumericReindexTransformer(BaseReindexTransformer):
+    def fit(self, X, y=None):
+        self.columns = X.select_dtypes(include=np.number).columns.tolist()
+        return self
+
+
+class DateReindexTransformer(BaseReindexTransformer):
+    def fit(self, X, y=None):
+        self.columns = X.filter(regex=".*Date.*").columns.tolist()
+        return self
+
+
+class StringReindexTransformer(BaseReindexTransformer):
+    def fit(self, X, y=None):
+        # Text is object with pandas 1 and str with pandas 3
+        self.columns = X.select_dtypes(include=[object, 'string']).columns.tolist()
+        return self
+
+
+class TokenizerTransformer(BaseEstimator, TransformerMixin):
+    def __init__(self, vectorizer):
+        self.vectorizer = vectorizer
+
+    @staticmethod
+    def _join_columns(df):
+        # Values of each row joined with spaces, concatenating whole columns at a time
+        columns = df.astype(str).fillna('').to_numpy(dtype=object).T
+        if len(columns) == 0:
+            return pd.Series('', index=df.index)
+        corpus = columns[0]
+        for column in columns[1:]:
+            corpus = corpus + ' ' + column
+        return pd.Series(corpus, index=df.index)
+
+    @classmethod
+    def _corpus(cls, X):
+        l, r = split(X)
+        return cls._join_columns(l), cls._join_columns(r)
+
+    def _transform(self, l_corpus, r_corpus):
+        l_transform = self.vectorizer.transform(l_corpus)
+        r_transform = self.vectorizer.transform(r_corpus)
+        return (l_transform - r_transform).sign()
+
+    def __sklearn_is_fitted__(self):
+        return hasattr(self.vectorizer, 'vocabulary_')
+
+    def fit(self, X, y=None):
+        self.vectorizer.fit(self._corpus(X)[0])
+        return self
+
+    def fit_transform(self, X, y=None, **fit_params):
+        l_corpus, r_corpus = self._corpus(X)
+        self.vectorizer.fit(l_corpus)
+        return self._transform(l_corpus, r_corpus)
+
+    def transform(self, X, y=None):
+        l_corpus, r_corpus = self._corpus(X)
+        return self._transform(l_corpus, r_corpus)
+
+
+def to_numeric(df):
+    return df.apply(pd.to_numeric, errors='coerce')
+
+
+def split_cmp(df):
+    """Split into left and right sides a calculate sign of the difference. Values need to be numeric"""
+    l, r = split(df)
+    # NOTE: 0-NaN should probably equal 1, but using fill_value=0 means it is evaluated as 0-0=0
+    d = l.sub(r.values, fill_value=0).fillna(0)
+    cmp = np.sign(d)
+    return cmp
+
+
+def to_datetime_value(df):
+    # All columns are parsed in one call, NaT becomes the minimum int64 like NaT.value
+    values = pd.to_datetime(
+        pd.Series(df.to_numpy(dtype=object).ravel()),
+        format='%Y:%m:%d %H:%M:%S',
+        errors='coerce',
+        exact=False
+    ).to_numpy(dtype='datetime64[ns]').view('int64')
+    return pd.DataFrame(values.reshape(df.shape), index=df.index, columns=df.columns)
+
+
+def str_len(df):
+    lengths = pd.Series(df.astype(str).fillna('').to_numpy(dtype=object).ravel()).str.len().to_numpy(dtype='int64')
+    return pd.DataFrame(lengths.reshape(df.shape), index=df.index, columns=df.columns)
+
+
+def make_pipeline():
+    return Pipeline([
+        ('feature_union', FeatureUnion([
+            ('numeric_pipeline', Pipeline([
+                ('reindex', NumericReindexTransformer()),
+                ('to_numeric', FunctionTransformer(to_numeric)),
+                ('cmp', FunctionTransformer(split_cmp)),
+            ])),
+            ('date_pipeline', Pipeline([
+                ('reindex', DateReindexTransformer()),
+                ('to_datetime_value', FunctionTransformer(to_datetime_value)),
+                ('cmp', FunctionTransformer(split_cmp)),
+            ])),
+            ('string_len_pipeline', Pipeline([
+                ('reindex', StringReindexTransformer()),
+                ('str_len', FunctionTransformer(str_len)),
+                ('cmp', FunctionTransformer(split_cmp)),
+            ])),
+            ('tokenizer_pipeline', Pipeline([
+                ('reindex', StringReindexTransformer()),
+                ('tokenizer', TokenizerTransformer(CountVectorizer())),
+            ])),
+        ])),
+        ('model', RandomForestClassifier())
+    ])
+
+
+def metadata_frame(rows):
+    # Frame of the metadata of rows indexed by hex dhash. The JSON is parsed by pandas in one call.
+    if not rows:
+        return pd.DataFrame()
+    frame = pd.read_json(
+        io.StringIO('\n'.join(row['metadata'] for row in rows)),
+        lines=True,
+        dtype=False,
+        convert_dates=False
+    )
+    frame.index = [row['dhash'].hex() for row in rows]
+    return frame
+
+
+def join(deleted, saved):
+    # Pairs every deleted image with every kept image of the same dhash, both ways round. y is 1 when the right image
+    # was kept.
+    merged = pd.concat([deleted, saved])
+    positions = pd.merge(
+        pd.DataFrame({'dhash': deleted.index, 'deleted': range(len(deleted))}),
+        pd.DataFrame({'dhash': saved.index, 'saved': range(len(deleted), len(merged))}),
+        on='dhash'
+    )
+    # Limit the number of pairs of hashes with many images
+    positions = positions.sample(frac=1, random_state=0).groupby('dhash').head(MAX_PAIRS_PER_DHASH)
+
+    left = np.concatenate([positions['deleted'], positions['saved']])
+    right = np.concatenate([positions['saved'], positions['deleted']])
+    X = pd.concat([
+        merged.iloc[left].add_suffix('_l').reset_index(drop=True),
+        merged.iloc[right].add_suffix('_r').reset_index(drop=True),
+    ], axis=1)
+    y = pd.Series(np.repeat([1, -1], len(positions)))
+    return X, y
@@ -1,89 +1,206 @@
 import json
+import os
+import pickle
 import time
-from collections import defaultdict
 
+import numpy as np
 import pandas as pd
+from scipy.sparse import vstack
+from sklearn.base import clone
 from sklearn.model_selection import train_test_split
+from . import legacy
 from .cmp import pipeline
-
-
-def build_predictor(db, cache_dir):
-    print("Loading json features")
-    deleted = load_json(cache_dir)
-    print(f"...{len(deleted)} features")
-
-    print("Loading from database")
-    saved = load_db(db, deleted.keys())
-    print(f"...{len(saved)} features")
-
-    if len(deleted) == 0 or len(saved) == 0:
-        return lambda a, b: 0
-
-    print("Fitting data")
-    X, y = join(deleted, saved)
-    X_train, X_test, y_train, y_test = train_test_split(X, y)
-    pipeline.fit(X_train, y_train)
-    print('...R2 score: {0:.2f}'.format(pipeline.score(X_test, y_test)))
-
-    def predict(a, b):
-        X, _ = join({0: [a]}, {0: [b]})
+from .features import FEATURE_VERSION, image_features, pack_features, pair_features, unpack_features
+
+MODEL_FILE = 'model.pickle'
+# Training pairs of deleted and kept images sampled from each dhash
+MAX_PAIRS_PER_DHASH = 1000
+
+
+class Predictor(object):
+    # Ranks images with the pipeline fitted by train(), which is saved in cache_dir with the version of the deleted
+    # table it was fitted on. Ranking uses the previous pipeline while train() runs.
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.fingerprint, self.pipeline = load_model(cache_dir)
+
+    def is_stale(self, db):
+        return self.fingerprint != training_fingerprint(db)
+
+    def train(self, db):
+        fingerprint = training_fingerprint(db)
+
+        print("Loading deleted features")
+        deleted = db.deleted_select().fetchall()
+        print(f"...{len(deleted)} features")
+
+        print("Loading from database")
+        saved = db.image_select_deleted_dhash().fetchall()
+        print(f"...{len(saved)} features")
+
+        if len(deleted) == 0 or len(saved) == 0:
+            return
+
+        print("Fitting data")
+        X, y = join(db, deleted, saved)
+        X_train, X_test, y_train, y_test = train_test_split(X, y)
+        if len(np.unique(y_train)) < 2:
+            # ie. a single deletion, the model could only predict one class
+            print("...not enough pairs to fit")
+            return
+        # Fit a copy so ranking can use the current pipeline meanwhile
+        fitted = clone(pipeline).fit(X_train, y_train)
+        print('...R2 score: {0:.2f}'.format(fitted.score(X_test, y_test)))
+
+        save_model(self.cache_dir, fingerprint, fitted)
+        self.fingerprint, self.pipeline = fingerprint, fitted
+
+    def __call__(self, db, groups):
+        # Orders the metadata of each group by the probability of keeping each image summed over every other image in
+        # the group. All pairs of all groups are scored in one call.
+        fitted = self.pipeline
+        pairs = [
+            (g, i, j)
+            for g, group in enumerate(groups)
+            for i in range(len(group))
+            for j in range(len(group))
+            if i != j
+        ]
+        if fitted is None or not pairs:
+            return groups
 
         start = time.perf_counter()
-        prediction = pipeline.predict(X.iloc[:1])
+        images = [metadata for group in groups for metadata in group]
+        vectors = image_vectors(db, [metadata['SourceFile'] for metadata in images], images)
+        offsets = np.cumsum([0] + [len(group) for group in groups])
+        X = pair_features(
+            vectors,
+            [offsets[g] + i for g, i, _ in pairs],
+            [offsets[g] + j for g, _, j in pairs],
+        )
+        # Probability that the right image is kept
+        classes = list(fitted.classes_)
+        # A model fitted on one class only, ie. saved before that was checked, never predicts a kept image
+        keep_r = fitted.predict_proba(X)[:, classes.index(1)] if 1 in classes else np.zeros(len(pairs))
+        scores = [[0.0] * len(group) for group in groups]
+        for (g, i, j), p in zip(pairs, keep_r):
+            scores[g][j] += p
+            scores[g][i] += 1 - p
         end = time.perf_counter()
-        print(f"{a['SourceFile']} {b['SourceFile']} y={prediction} {end-start:.2f}s")
-        return prediction
-    return predict
-
-
-def load_json(cache_dir):
-    features = defaultdict(list)
-    for file in cache_dir.glob('*.json'):
-        with file.open() as f:
-            dhash, metadata = json.load(f)
-            features[dhash].append(metadata)
-    return features
-
-
-def load_db(db, hashes):
-    features = defaultdict(list)
-    for dhash in hashes:
-        for row in db.image_select_by_dhash(bytes.fromhex(dhash)):
-            metadata = json.loads(row['metadata'])
-            features[dhash].append(metadata)
-    return features
-
-
-def join(deleted, saved):
-    def _from_records(records):
-        data = [metadata for dhash in records for metadata in records[dhash]]
-        index = [dhash for dhash in records for _ in records[dhash]]
-        return pd.DataFrame.from_records(data, index=index,)
-    deleted_df = _from_records(deleted)
-    deleted_df['Keep'] = -1
-    saved_df = _from_records(saved)
-    saved_df['Keep'] = 1
-
-    merged = deleted_df.append(saved_df)
-
-    # Keep_l=-1, Keep_r=1
-    deleted_saved = merged[merged['Keep'] == -1].join(
-        merged[merged['Keep'] == 1], 
-        how="inner",
-        lsuffix='_l', 
-        rsuffix='_r'
+        print(f"Ranked {len(pairs)} pairs in {end-start:.2f}s")
+
+        return [
+            [metadata for _, metadata in sorted(zip(score, group), key=lambda x: -x[0])]
+            for score, group in zip(scores, groups)
+        ]
+
+
+def compare(db, test_size=0.25):
+    # Returns (pairs, accuracy of the feature vectors, accuracy of the pandas pipeline of learn.legacy) on the same
+    # held-out pairs, or None without enough deletions. Whole groups of a dhash are held out so no image is in both.
+    deleted = db.deleted_select().fetchall()
+    saved = db.image_select_deleted_dhash().fetchall()
+    hashes = sorted({row['dhash'] for row in deleted} & {row['dhash'] for row in saved})
+    if len(hashes) < 2:
+        return None
+    train_hashes, _ = train_test_split(hashes, test_size=test_size, random_state=0)
+    train_hashes = set(train_hashes)
+
+    def subset(rows, train):
+        return [row for row in rows if (row['dhash'] in train_hashes) == train]
+
+    def score(make, join_subset):
+        X_train, y_train = join_subset(subset(deleted, True), subset(saved, True))
+        X_test, y_test = join_subset(subset(deleted, False), subset(saved, False))
+        return len(y_test), make().set_params(model__random_state=0).fit(X_train, y_train).score(X_test, y_test)
+
+    pairs, accuracy = score(lambda: clone(pipeline), lambda d, s: join(db, d, s))
+    _, legacy_accuracy = score(
+        legacy.make_pipeline,
+        lambda d, s: legacy.join(legacy.metadata_frame(d), legacy.metadata_frame(s))
     )
-
-    # Keep_l=1, Keep_r=-1
-    saved_deleted = merged[merged['Keep'] == 1].join(
-        merged[merged['Keep'] == -1], 
-        how="inner",
-        lsuffix='_l', 
-        rsuffix='_r'
+    return pairs, accuracy, legacy_accuracy
+
+
+def training_fingerprint(db):
+    return (FEATURE_VERSION, *db.deleted_select_version())
+
+
+def image_vectors(db, file_names, metadata, rows=None):
+    # Feature vectors of images, stored by scan or computed from metadata and stored if missing or outdated. metadata
+    # may be JSON text, which is only parsed when needed. rows are image_features rows of file_names if already
+    # selected.
+    if rows is None:
+        rows = db.image_features_select(file_names)
+    stored = {row['file_name']: row for row in rows if row['version'] == FEATURE_VERSION}
+    packed = []
+    computed = []
+    for file_name, image_metadata in zip(file_names, metadata):
+        row = stored.get(file_name)
+        if row is None:
+            if isinstance(image_metadata, str):
+                image_metadata = json.loads(image_metadata)
+            features = pack_features(image_features(image_metadata))
+            computed.append((file_name, *features))
+            packed.append(features[1:])
+        else:
+            packed.append((row['indices'], row['data']))
+    if computed:
+        db.image_features_update(computed)
+    return unpack_features(packed)
+
+
+def load_model(cache_dir):
+    # Returns (fingerprint, pipeline) or (None, None) if there is no model that can be loaded
+    try:
+        with (cache_dir / MODEL_FILE).open('rb') as f:
+            fingerprint, fitted = pickle.load(f)
+    except FileNotFoundError:
+        return None, None
+    except Exception as e:
+        # ie. saved by another version of scikit-learn, or the pandas pipeline of learn.legacy
+        print(f"# WARNING ignoring saved model: {e}")
+        return None, None
+    if len(fingerprint) != 3 or fingerprint[0] != FEATURE_VERSION:
+        # Fitted on other features, ie. before FEATURE_VERSION was part of the fingerprint, so it can't rank vectors
+        print("# WARNING ignoring saved model fitted on other features, it is fitted again")
+        return None, None
+    return fingerprint, fitted
+
+
+def save_model(cache_dir, fingerprint, fitted):
+    temp_file = cache_dir / f'{MODEL_FILE}.tmp'
+    with temp_file.open('wb') as f:
+        pickle.dump((fingerprint, fitted), f)
+    os.replace(temp_file, cache_dir / MODEL_FILE)
+
+
+def join(db, deleted, saved):
+    # Pairs every deleted image with every kept image of the same dhash, both ways round. y is 1 when the right image
+    # was kept.
+    # Deleted images are no longer in images so their vectors are always computed
+    deleted_vectors = unpack_features([
+        pack_features(image_features(json.loads(row['metadata'])))[1:]
+        for row in deleted
+    ])
+    saved_vectors = image_vectors(
+        db,
+        [row['file_name'] for row in saved],
+        [row['metadata'] for row in saved],
+        [row for row in saved if row['version'] is not None]
     )
+    vectors = vstack([deleted_vectors, saved_vectors], format='csr')
 
-    joined = deleted_saved.append(saved_deleted)
+    positions = pd.merge(
+        pd.DataFrame({'dhash': [row['dhash'] for row in deleted], 'deleted': range(len(deleted))}),
+        pd.DataFrame({'dhash': [row['dhash'] for row in saved], 'saved': range(len(deleted), vectors.shape[0])}),
+        on='dhash'
+    )
+    # Limit the number of pairs of hashes with many images
+    positions = positions.sample(frac=1, random_state=0).groupby('dhash').head(MAX_PAIRS_PER_DHASH)
 
-    X = joined.drop(['Keep_l', 'Keep_r'], axis=1)
-    y = joined['Keep_r']
-    return X, y
+    left = np.concatenate([positions['deleted'], positions['saved']])
+    right = np.concatenate([positions['saved'], positions['deleted']])
+    y = np.repeat([1, -1], len(positions))
+    return pair_features(vectors, left, right), y
@@ -0,0 +1,53 @@
+import json
+import struct
+import zlib
+from collections import Counter
+
+# Compact encoding of metadata: the id of a shared dictionary followed by the compact JSON compressed with deflate
+# primed with that dictionary. Key names and common values repeated in every row are then stored once in the
+# dictionary instead of in each row.
+HEADER = struct.Struct('<I')
+# Largest dictionary deflate can use
+DICTIONARY_BYTES = 32 * 1024
+LEVEL = 9
+
+
+def _dumps(metadata):
+    return json.dumps(metadata, separators=(',', ':'))
+
+
+def build_dictionary(samples):
+    # Dictionary of the JSON fragments, ie. "MIMEType":"image/jpeg", of a sample of metadata that save the most bytes,
+    # most common last as deflate finds closer matches with shorter codes
+    fragments = Counter()
+    for metadata in samples:
+        for key, value in metadata.items():
+            fragments[_dumps({key: value})[1:-1]] += 1
+            fragments[f'{_dumps(key)}:'] += 1
+    chosen = []
+    size = 0
+    for fragment, count in sorted(fragments.items(), key=lambda x: -x[1] * len(x[0])):
+        if count < 2:
+            # Sorted by bytes saved, so shorter repeated fragments can come after
+            continue
+        fragment = fragment.encode()
+        if size + len(fragment) + 1 > DICTIONARY_BYTES:
+            continue
+        chosen.append(fragment)
+        size += len(fragment) + 1
+    return b','.join(reversed(chosen))
+
+
+def encode(metadata, dictionary_id, dictionary):
+    compressor = zlib.compressobj(LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+    return HEADER.pack(dictionary_id) + compressor.compress(_dumps(metadata).encode()) + compressor.flush()
+
+
+def dictionary_id(blob):
+    return HEADER.unpack_from(blob)[0]
+
+
+def decode(blob, dictionaries):
+    # JSON text of blob, dictionaries maps dictionary ids to dictionaries
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=dictionaries[dictionary_id(blob)])
+    return (decompressor.decompress(blob[HEADER.size:]) + decompressor.flush()).decode()
@@ -4,15 +4,15 @@ from exif import Exif
 
 class Plugin(object):
 
-    def __init__(self, config, sql_select, sql_params):
+    def __init__(self, config, select):
         self.cache_dir = config.cache_dir
-        self.sql_select = sql_select
-        self.sql_params = sql_params
+        # Function of a DB returning the rows to process, ie. with DB.image_select_tags()
+        self.select = select
 
     def execute(self):
         with DB(self.cache_dir) as db:
             with Exif() as et:
-                for row in db._execute(self.sql_select, self.sql_params):
+                for row in self.select(db):
                     self.process_row(et, row)
 
     def process_row(self, et, row):
@@ -0,0 +1,50 @@
+import json
+import time
+from collections import Counter
+from pathlib import Path
+
+from commands.scan import ScanCommand
+from plugins import Plugin
+
+
+class CheckFastDecodeCommand(Plugin):
+    # Compares the dhash of a random sample of images decoded in full and with scan --fast-decode
+
+    def __init__(self, config):
+        super().__init__(
+            config,
+            lambda db: db.image_select_tags(hashed=True, random=True, limit=config.number)
+        )
+        self.verbose = config.verbose
+        self.distances = Counter()
+        self.full_time = 0
+        self.fast_time = 0
+
+    def execute(self):
+        super().execute()
+        total = sum(self.distances.values())
+        if not total:
+            print("No images to check")
+            return
+        print(f"{total} images, full decode {self.full_time:.1f}s, fast decode {self.fast_time:.1f}s")
+        for distance, count in sorted(self.distances.items()):
+            print(f"{distance:3d} bits different: {count} ({100 * count / total:.1f}%)")
+
+    def process_row(self, et, row):
+        file = Path(row['file_name'])
+        if not file.exists():
+            return
+        metadata = json.loads(row['metadata'])
+
+        start = time.perf_counter()
+        full = ScanCommand.read_dhash(file)
+        self.full_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        fast = ScanCommand.read_dhash(file, et, metadata, fast_decode=True)
+        self.fast_time += time.perf_counter() - start
+
+        distance = bin(int.from_bytes(full, 'big') ^ int.from_bytes(fast, 'big')).count('1')
+        self.distances[distance] += 1
+        if self.verbose and distance:
+            print(f"{file} {distance} bits different")
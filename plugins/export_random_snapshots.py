@@ -15,8 +15,7 @@ class RandomSnapshotsCommand(Plugin):
     def __init__(self, config):
         super().__init__(
             config,
-            r'''SELECT * FROM images ORDER BY RANDOM() LIMIT ?''',
-            (config.number,)
+            lambda db: db.image_select_tags(random=True, limit=config.number)
         )
         self.export_dir = str(config.export_dir)
         self.verbose = config.verbose
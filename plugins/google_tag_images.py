@@ -10,8 +10,7 @@ class GoogleTagImages(Plugin):
     def __init__(self, config):
         super().__init__(
             config,
-            r'''SELECT * FROM images WHERE json_extract(metadata, '$.Keywords') is NULL ORDER BY RANDOM() LIMIT ?''',
-            (config.number,)
+            lambda db: db.image_select_tags(Keywords=None, random=True, limit=config.number)
         )
 
     def process_row(self, et: Exif, row):
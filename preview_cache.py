@@ -0,0 +1,124 @@
+import hashlib
+import os
+import threading
+
+from wand.image import Image
+
+# Longest side in pixels of each size of preview, named like Synology thumbnails. original is a full size JPEG of
+# images browsers can't show, ie. HEIC.
+PREVIEW_SIZES = {
+    'M': 640,
+    'XL': 1280,
+    'original': None,
+}
+PREVIEW_QUALITY = 85
+
+
+class PreviewCache(object):
+    # JPEG previews of images kept in directory and keyed by the path, mtime and size of the original. The least
+    # recently used previews are removed once all previews take more than max_bytes. Each process, ie. scan worker, 
+    # has its own instance and its own count of total bytes, only read from the directory again on eviction.
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._total_bytes = None
+
+    @staticmethod
+    def key(file, stat, size):
+        key = f'{file}\0{stat.st_mtime}\0{stat.st_size}\0{size}'
+        return hashlib.sha1(key.encode('utf-8', 'surrogateescape')).hexdigest()
+
+    def path(self, key):
+        return self.directory / key[:2] / f'{key}.jpg'
+
+    def exists(self, file, stat, size='XL'):
+        return self.path(self.key(file, stat, size)).exists()
+
+    def open(self, file, stat, size='XL'):
+        # Returns (open file, key) of the preview of file, creating it if needed. The preview is opened here so it can 
+        # still be read if another thread or process evicts it meanwhile.
+        key = self.key(file, stat, size)
+        path = self.path(key)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return self.create(file, path, PREVIEW_SIZES[size]), key
+        # mtime is the last use for eviction as NAS volumes are often mounted noatime
+        os.utime(f.fileno())
+        return f, key
+
+    def put(self, file, stat, image, size='XL'):
+        # Store a preview of file from an image that was already read
+        self.create(file, self.path(self.key(file, stat, size)), PREVIEW_SIZES[size], image).close()
+
+    def create(self, file, path, pixels, image=None):
+        # Write a preview of file, or of image when it was already read, to path. Returns the preview opened before it
+        # is visible to eviction.
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(f'{path.stem}.{threading.get_ident()}.tmp')
+        if image is None:
+            with Image() as image:
+                if pixels:
+                    # Let libjpeg scale down while decoding
+                    image.options['jpeg:size'] = f'{pixels}x{pixels}'
+                image.read(filename=str(file))
+                self._save(image, temp_path, pixels)
+        else:
+            self._save(image, temp_path, pixels)
+        f = open(temp_path, 'rb')
+        os.replace(temp_path, path)
+        self._add(os.fstat(f.fileno()).st_size)
+        return f
+
+    @staticmethod
+    def _save(image, path, pixels):
+        with image.sequence[0].clone() as preview:
+            preview.auto_orient()
+            if pixels:
+                preview.transform(resize=f'{pixels}x{pixels}>')
+            preview.strip()
+            preview.format = 'jpeg'
+            preview.compression_quality = PREVIEW_QUALITY
+            preview.save(filename=str(path))
+
+    def remove(self, file, stat):
+        for size in PREVIEW_SIZES:
+            path = self.path(self.key(file, stat, size))
+            try:
+                nbytes = path.stat().st_size
+                path.unlink()
+            except FileNotFoundError:
+                continue
+            self._add(-nbytes)
+
+    def _add(self, nbytes):
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = sum(nbytes for _, nbytes, _ in self._list())
+            else:
+                self._total_bytes += nbytes
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Remove least recently used previews until they take 3/4 of max_bytes
+        previews = sorted(self._list())
+        self._total_bytes = sum(nbytes for _, nbytes, _ in previews)
+        for _, nbytes, path in previews:
+            if self._total_bytes <= self.max_bytes * 3 // 4:
+                break
+            path.unlink(missing_ok=True)
+            self._total_bytes -= nbytes
+
+    def _list(self):
+        # (mtime, size, path) of each preview. Other processes, ie. scan workers, may be evicting at the same time.
+        previews = []
+        for path in self.directory.glob('*/*.jpg'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            previews.append((stat.st_mtime, stat.st_size, path))
+        return previews
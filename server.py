@@ -0,0 +1,94 @@
+import os
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler
+from wsgiref.simple_server import ServerHandler, WSGIRequestHandler, WSGIServer
+
+
+class SendfileServerHandler(ServerHandler):
+
+    def sendfile(self):
+        # Copy files returned through wsgi.file_wrapper, ie. by flask.send_file(), from the page cache to the socket
+        # with os.sendfile(). Other responses are written by the caller.
+        try:
+            in_fd = self.result.filelike.fileno()
+        except (AttributeError, OSError):
+            return False
+        if not hasattr(os, 'sendfile'):
+            return False
+        if not self.headers_sent:
+            self.send_headers()
+        self._flush()
+        offset = self.result.filelike.tell()
+        remaining = os.fstat(in_fd).st_size - offset
+        out_fd = self.stdout.fileno()
+        while remaining > 0:
+            sent = os.sendfile(out_fd, in_fd, offset, remaining)
+            if sent == 0:
+                break
+            offset += sent
+            remaining -= sent
+            self.bytes_sent += sent
+        return True
+
+
+class PoolRequestHandler(WSGIRequestHandler):
+    # BaseHTTPRequestHandler reads the request and calls do_<method>(), which runs the app with SendfileServerHandler
+    # instead of the ServerHandler created by WSGIRequestHandler.handle()
+
+    def handle(self):
+        BaseHTTPRequestHandler.handle(self)
+
+    def run_app(self):
+        handler = SendfileServerHandler(
+            self.rfile, self.wfile, self.get_stderr(), self.get_environ(), multithread=True
+        )
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_DELETE = do_PATCH = do_OPTIONS = run_app
+
+
+class PoolWSGIServer(WSGIServer):
+    # Requests are handled by a fixed number of threads, so each thread can keep its own DB connection. on_thread_exit
+    # is called by each of them when the server is closed, ie. to close that connection.
+
+    def __init__(self, server_address, threads, on_thread_exit=None):
+        self._requests = queue.SimpleQueue()
+        self._on_thread_exit = on_thread_exit
+        # Before binding, which calls server_close() on failure
+        self._threads = [threading.Thread(target=self._handle_requests) for _ in range(threads)]
+        for thread in self._threads:
+            thread.start()
+        super().__init__(server_address, PoolRequestHandler)
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+    def _handle_requests(self):
+        try:
+            for request, client_address in iter(self._requests.get, None):
+                try:
+                    self.finish_request(request, client_address)
+                except Exception:
+                    self.handle_error(request, client_address)
+                finally:
+                    self.shutdown_request(request)
+        finally:
+            if self._on_thread_exit:
+                self._on_thread_exit()
+
+    def server_close(self):
+        super().server_close()
+        # Requests already accepted are answered first
+        for _ in self._threads:
+            self._requests.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+def serve(app, host, port, threads, on_thread_exit=None):
+    with PoolWSGIServer((host, port), threads, on_thread_exit) as server:
+        server.set_app(app)
+        print(f" * Running on http://{host}:{port}/ with {threads} threads")
+        server.serve_forever()
@@ -3,14 +3,13 @@
 import argparse
 import sys
 
-from commands import browse, cp, mv, organize, scan
+from commands import browse, cluster, compact, cp, mv, organize, purge, scan, train
 from exceptions import UserError
 from file_utils import normalized_path
-from plugins import export_random_snapshots, google_tag_images
+from plugins import check_fast_decode, export_random_snapshots, google_tag_images
 
 CACHE_DIR = '~/.cache/shashin/'
 
-# TODO make configurable
 SKIP_DIRS = ['@eaDir', "#snapshot"]
 DEFAULT_HIERARCHY = r'''
 {% if DateTimeOriginal and DateTimeOriginal|datetime %}
@@ -33,28 +32,82 @@ def get_parser():
     subparsers = parser.add_subparsers(dest='command')
     subparsers.required = True
 
-    scan_parser = subparsers.add_parser("scan")
+    # Options of commands that walk directories
+    walk_parser = argparse.ArgumentParser(add_help=False)
+    walk_parser.add_argument('--skip-dir', dest='skip_dirs', action='append', metavar='PATTERN',
+                             help=f'skip directories with names matching PATTERN, can be repeated (default: {SKIP_DIRS})')
+    walk_parser.add_argument('--walk-threads', type=int, default=4,
+                             help='number of threads listing directories (default: %(default)s)')
+
+    # Options of commands that use the preview cache
+    preview_parser = argparse.ArgumentParser(add_help=False)
+    preview_parser.add_argument('--preview-cache-size', type=int, default=1024,
+                                help='maximum size of cached previews in MB (default: %(default)s)')
+
+    scan_parser = subparsers.add_parser("scan", parents=[walk_parser, preview_parser])
     scan_parser.add_argument("scan_dirs", nargs='+', help="directories of images to scan")
+    scan_parser.add_argument('-j', '--jobs', type=int, default=1,
+                             help='number of worker processes for reading metadata and hashing (default: %(default)s)')
+    scan_parser.add_argument('--fast-decode', action='store_true',
+                             help='decode reduced size images or embedded previews for hashing')
+    scan_parser.add_argument('--previews', choices=['all', 'duplicates'],
+                             help='create browse previews of all images or only those with duplicates')
+    scan_parser.add_argument('--preview-jobs', type=int, default=1,
+                             help='number of worker processes creating previews of images (default: %(default)s)')
+    scan_parser.add_argument('--nice', action='store_true',
+                             help='run at low CPU and IO priority')
     scan_parser.set_defaults(cls=scan.ScanCommand)
 
-    browse_parser = subparsers.add_parser("browse")
+    purge_parser = subparsers.add_parser("purge")
+    purge_parser.set_defaults(cls=purge.PurgeCommand)
+
+    cluster_parser = subparsers.add_parser("cluster")
+    cluster_parser.add_argument('--max-distance', type=int, default=4,
+                                help='group images with hashes differing by up to this many bits (default: %(default)s)')
+    cluster_parser.add_argument('--incremental', action='store_true',
+                                help='only compare hashes scanned since the last run')
+    cluster_parser.set_defaults(cls=cluster.ClusterCommand)
+
+    train_parser = subparsers.add_parser("train")
+    train_parser.add_argument('--force', action='store_true',
+                              help='fit the model even if there are no new deletions')
+    train_parser.add_argument('--compare', action='store_true',
+                              help='compare the accuracy of the feature vectors with the pandas pipeline used before, '
+                                   'on held-out groups of deleted images')
+    train_parser.set_defaults(cls=train.TrainCommand)
+
+    compact_parser = subparsers.add_parser("compact")
+    compact_parser.add_argument('--sample-size', type=int, default=1000,
+                                help='number of images the shared dictionary is built from (default: %(default)s)')
+    compact_parser.set_defaults(cls=compact.CompactCommand)
+
+    browse_parser = subparsers.add_parser("browse", parents=[preview_parser])
+    browse_groups = browse_parser.add_mutually_exclusive_group()
+    browse_groups.add_argument('--max-distance', type=int, default=0,
+                               help='group images with hashes differing by up to this many bits (default: %(default)s)')
+    browse_groups.add_argument('--clusters', action='store_true',
+                               help='use the groups found by the cluster command')
+    browse_parser.add_argument('--threads', type=int, default=8,
+                               help='number of threads serving requests (default: %(default)s)')
+    browse_parser.add_argument('--exif-processes', type=int, default=2,
+                               help='maximum number of exiftool processes reading modified files (default: %(default)s)')
     browse_parser.set_defaults(cls=browse.BrowseCommand)
 
-    cp_parser = subparsers.add_parser("cp")
+    cp_parser = subparsers.add_parser("cp", parents=[walk_parser])
     cp_parser.add_argument("src")
     cp_parser.add_argument("dest")
     cp_parser.add_argument('--hierarchy', default=DEFAULT_HIERARCHY)    
     cp_parser.add_argument('--dry-run', action='store_true')    
     cp_parser.set_defaults(cls=cp.CopyCommand)
 
-    mv_parser = subparsers.add_parser("mv")
+    mv_parser = subparsers.add_parser("mv", parents=[walk_parser])
     mv_parser.add_argument("src")
     mv_parser.add_argument("dest")
     mv_parser.add_argument('--hierarchy', default=DEFAULT_HIERARCHY)
     mv_parser.add_argument('--dry-run', action='store_true')    
     mv_parser.set_defaults(cls=mv.MoveCommand)
 
-    organize_parser = subparsers.add_parser("organize")
+    organize_parser = subparsers.add_parser("organize", parents=[walk_parser])
     organize_parser.add_argument("src")
     organize_parser.add_argument('--hierarchy', default=DEFAULT_HIERARCHY)
     organize_parser.add_argument('--dry-run', action='store_true')    
@@ -65,6 +118,10 @@ def get_parser():
     export_random_snapshots_parser.add_argument("--number", default=10)
     export_random_snapshots_parser.set_defaults(cls=export_random_snapshots.RandomSnapshotsCommand)
 
+    check_fast_decode_parser = subparsers.add_parser("check-fast-decode")
+    check_fast_decode_parser.add_argument("--number", default=100)
+    check_fast_decode_parser.set_defaults(cls=check_fast_decode.CheckFastDecodeCommand)
+
     google_tag_images_parser = subparsers.add_parser("google-tag-images")
     google_tag_images_parser.add_argument("--number", default=1)
     google_tag_images_parser.set_defaults(cls=google_tag_images.GoogleTagImages)
@@ -75,6 +132,8 @@ def get_parser():
 def main(args):
     parser = get_parser()
     config = parser.parse_args(args)
+    if 'skip_dirs' in config and config.skip_dirs is None:
+        config.skip_dirs = SKIP_DIRS
 
     # Check that cache_dir exists or create it
     config.cache_dir = normalized_path(config.cache_dir)
@@ -0,0 +1,92 @@
+import numpy as np
+
+# dhash are 16 bytes, split into DHASH_BLOCKS blocks for multi-index hashing. Two hashes that differ by at most
+# DHASH_BLOCKS - 1 bits have at least one block in common.
+DHASH_BYTES = 16
+DHASH_BLOCKS = 8
+BLOCK_BYTES = DHASH_BYTES // DHASH_BLOCKS
+MAX_DISTANCE = DHASH_BLOCKS - 1
+
+
+def hamming_distance(a, b):
+    # Number of bits different between two dhash
+    return bin(int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')).count('1')
+
+
+def dhash_blocks(dhash):
+    return [bytes(dhash[i:i + BLOCK_BYTES]) for i in range(0, DHASH_BYTES, BLOCK_BYTES)]
+
+
+def block_expression(block, column='dhash'):
+    # SQL expression of a block of the dhash. Queries must use the same expression as the index.
+    return f'substr({column}, {block * BLOCK_BYTES + 1}, {BLOCK_BYTES})'
+
+
+# Upper bound on the number of pairs compared at once by similar_pairs(), about 50 bytes of memory each
+CHUNK_PAIRS = 1 << 21
+
+
+def popcount(x):
+    # Number of bits set in each element of a uint64 array
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x)
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+    return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+
+def similar_pairs(hashes, max_distance, new=None, chunk_pairs=CHUNK_PAIRS):
+    # Yields arrays (i, j) of indexes of hashes at most max_distance bits apart. Only hashes sharing a block are compared,
+    # a bucket at a time after sorting on the block. When new, a boolean array, is given only pairs with a new hash are
+    # compared. The same pair can be yielded more than once.
+    packed = b''.join(hashes)
+    words = np.frombuffer(packed, dtype='>u8').astype(np.uint64).reshape(-1, DHASH_BYTES // 8)
+    blocks = np.frombuffer(packed, dtype=f'>u{BLOCK_BYTES}').reshape(-1, DHASH_BLOCKS)
+    for block in range(DHASH_BLOCKS):
+        order = np.argsort(blocks[:, block], kind='stable')
+        keys = blocks[order, block]
+        positions = np.arange(len(keys))
+        end = np.searchsorted(keys, keys, 'right')
+        if new is None:
+            # Each pair once, with every later hash in the bucket
+            start = positions + 1
+        else:
+            positions = positions[new[order]]
+            start = np.searchsorted(keys, keys[positions], 'left')
+            end = end[positions]
+        counts = end - start
+        total = np.cumsum(counts)
+
+        first = 0
+        while first < len(positions):
+            done = total[first - 1] if first else 0
+            last = max(int(np.searchsorted(total, done + chunk_pairs, 'right')), first + 1)
+            chunk_counts = counts[first:last]
+            left = np.repeat(positions[first:last], chunk_counts)
+            offsets = np.arange(chunk_counts.sum()) - np.repeat(np.cumsum(chunk_counts) - chunk_counts, chunk_counts)
+            right = np.repeat(start[first:last], chunk_counts) + offsets
+            i, j = order[left], order[right]
+            distance = sum(popcount(words[i, w] ^ words[j, w]) for w in range(words.shape[1]))
+            match = (distance <= max_distance) & (i != j)
+            yield i[match], j[match]
+            first = last
+
+
+def cluster(hashes, max_distance, groups=None, new=None):
+    # Union-find of hashes at most max_distance bits apart. hashes must be sorted. Returns the index of the first hash 
+    # of the group of each hash. groups are the indexes returned by an earlier run to add new hashes to.
+    parent = list(range(len(hashes))) if groups is None else list(groups)
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for i, j in similar_pairs(hashes, max_distance, new):
+        for a, b in zip(i.tolist(), j.tolist()):
+            a, b = find(a), find(b)
+            if a != b:
+                parent[max(a, b)] = min(a, b)
+    return [find(x) for x in range(len(hashes))]
@@ -0,0 +1,44 @@
+import hashlib
+import os
+from itertools import islice
+
+import numpy as np
+
+# Upper bound on memory used by a StatIndex, 8 bytes per file
+MAX_BYTES = 64 * 1024 * 1024
+
+
+class StatIndex(object):
+    # Set of (file_name, mtime, size) stored as a sorted array of 64 bit digests so rescans can find unchanged files
+    # without a query per file. When there are more rows than fit in max_bytes the index is incomplete and files
+    # missing from it have to be checked against the DB.
+
+    def __init__(self, rows, max_bytes=MAX_BYTES):
+        max_size = max_bytes // 8
+        digests = np.fromiter(
+            (self.digest(*row) for row in islice(rows, max_size + 1)),
+            dtype=np.uint64
+        )
+        self.complete = len(digests) <= max_size
+        self._digests = np.sort(digests[:max_size])
+
+    @staticmethod
+    def digest(file_name, mtime, size):
+        key = b'\0'.join([
+            os.fsencode(str(file_name)),
+            repr(float(mtime)).encode(),
+            str(int(size)).encode(),
+        ])
+        return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big')
+
+    def __contains__(self, stats):
+        digest = np.uint64(self.digest(*stats))
+        i = np.searchsorted(self._digests, digest)
+        return i < len(self._digests) and self._digests[i] == digest
+
+    def __len__(self):
+        return len(self._digests)
+
+    @property
+    def nbytes(self):
+        return self._digests.nbytes
@@ -0,0 +1,120 @@
+import db as db_module
+from db import DB
+
+
+def insert(db, file_name, **metadata):
+    metadata = {'SourceFile': file_name, 'MIMEType': 'image/jpeg', **metadata}
+    db.image_insert_or_replace(file_name=file_name, mtime=1, size=1, dhash=bytes(16), metadata=metadata)
+
+
+def test_new_hot_tag_after_compact(tmp_path, monkeypatch):
+    with DB(tmp_path) as db:
+        insert(db, '/a/1.jpg', Make='Apple')
+        insert(db, '/a/2.jpg', Make='Canon')
+        insert(db, '/a/3.jpg')
+        db.flush()
+        assert db.metadata_compact(10) == 3
+
+    monkeypatch.setattr(db_module, 'HOT_TAGS', db_module.HOT_TAGS + ['Make'])
+    monkeypatch.setattr(db_module, 'TAG_COLUMNS', db_module.TAG_COLUMNS + ['tag_Make'])
+    with DB(tmp_path) as db:
+        assert [row['file_name'] for row in db.image_select_tags(Make='Apple')] == ['/a/1.jpg']
+        assert [row['file_name'] for row in db.image_select_tags(Make=None)] == ['/a/3.jpg']
+
+
+def test_interrupted_tag_fill(tmp_path, monkeypatch):
+    with DB(tmp_path) as db:
+        insert(db, '/a/1.jpg', Make='Apple')
+        db.flush()
+
+    monkeypatch.setattr(db_module, 'HOT_TAGS', db_module.HOT_TAGS + ['Make'])
+    monkeypatch.setattr(db_module, 'TAG_COLUMNS', db_module.TAG_COLUMNS + ['tag_Make'])
+
+    def interrupted(self):
+        raise KeyboardInterrupt
+
+    with monkeypatch.context() as m:
+        m.setattr(DB, '_fill_tags', interrupted)
+        try:
+            DB(tmp_path).__enter__()
+        except KeyboardInterrupt:
+            pass
+    with DB(tmp_path) as db:
+        assert [row['file_name'] for row in db.image_select_tags(Make='Apple')] == ['/a/1.jpg']
+        assert db.image_select_tags(Make=None).fetchall() == []
+
+
+def test_interrupted_directory_stem_fill(tmp_path, monkeypatch):
+    with DB(tmp_path) as db:
+        insert(db, '/a/IMG_1.jpg')
+        insert(db, '/a/IMG_1.mov')
+        db.flush()
+        db._execute('DROP INDEX idx_directory_stem')
+        for column in ['directory', 'stem']:
+            db._execute(f'ALTER TABLE images DROP COLUMN {column}')
+
+    def interrupted(self):
+        raise KeyboardInterrupt
+
+    with monkeypatch.context() as m:
+        m.setattr(DB, '_fill_directory_stem', interrupted)
+        try:
+            DB(tmp_path).__enter__()
+        except KeyboardInterrupt:
+            pass
+    with DB(tmp_path) as db:
+        assert sorted(row['file_name'] for row in db.image_select_siblings(['/a/IMG_1.jpg'])) == [
+            '/a/IMG_1.jpg', '/a/IMG_1.mov'
+        ]
+
+
+def test_interrupted_dhash_groups_fill(tmp_path, monkeypatch):
+    with DB(tmp_path) as db:
+        insert(db, '/a/1.jpg')
+        insert(db, '/a/2.jpg')
+        db.flush()
+        # As a database made before dhash_groups
+        for trigger in ['images_insert_dhash_groups', 'images_delete_dhash_groups', 'images_update_dhash_groups',
+                        'ignore_insert_dhash_groups', 'ignore_delete_dhash_groups']:
+            db._execute(f'DROP TRIGGER {trigger}')
+        db._execute('DROP TABLE dhash_groups')
+
+    def interrupted(self):
+        raise KeyboardInterrupt
+
+    with monkeypatch.context() as m:
+        m.setattr(DB, '_create_dhash_groups', interrupted)
+        try:
+            DB(tmp_path).__enter__()
+        except KeyboardInterrupt:
+            pass
+    with DB(tmp_path) as db:
+        assert [(row['dhash'], row['count']) for row in db._execute('SELECT * FROM dhash_groups')] == [(bytes(16), 2)]
+
+
+def hash_bits(*bits):
+    return sum(1 << bit for bit in bits).to_bytes(16, 'big')
+
+
+def test_similar_groups_extend(tmp_path):
+    from commands.cluster import store_clusters
+
+    a, b, c, far = hash_bits(), hash_bits(0, 1, 2), hash_bits(0, 1, 2, 3, 4, 5), hash_bits(*range(100, 110))
+    with DB(tmp_path) as db:
+        for file_name, dhash in [('/a/1.jpg', a), ('/a/2.jpg', a), ('/c/1.jpg', c), ('/c/2.jpg', c)]:
+            db.image_insert_or_replace(file_name=file_name, mtime=1, size=1, dhash=dhash, metadata={})
+        db.flush()
+        rowid = db.image_select_last_rowid()
+        rows = db.dhash_select_clusters()
+        store_clusters(db, [row['dhash'] for row in rows], 4, 'similar_groups', [row['count'] for row in rows])
+        assert len(db.image_select_cluster_groups(b'', table='similar_groups')) == 2
+
+        # b is 3 bits from both a and c, which are 6 bits apart
+        for file_name, dhash in [('/b/1.jpg', b), ('/far/1.jpg', far)]:
+            db.image_insert_or_replace(file_name=file_name, mtime=1, size=1, dhash=dhash, metadata={})
+        rowid = db.similar_groups_extend(rowid, 4)
+        groups = db.image_select_cluster_groups(b'', table='similar_groups')
+        assert [sorted(row['file_name'] for row in rows) for _, rows in groups] == [
+            ['/a/1.jpg', '/a/2.jpg', '/b/1.jpg', '/c/1.jpg', '/c/2.jpg']
+        ]
+        assert db.similar_groups_extend(rowid, 4) == rowid
@@ -0,0 +1,73 @@
+import json
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from learn import legacy
+from learn.utils import split
+
+DATA = Path(__file__).parent / 'data' / 'metadata.jsonl'
+
+
+# Per-row reference implementations the vectorized transforms replaced
+
+def applymap(df, func):
+    # DataFrame.applymap was renamed DataFrame.map in pandas 2.1
+    return df.map(func) if hasattr(df, 'map') else df.applymap(func)
+
+
+def old_to_datetime_value(df):
+    return applymap(
+        df.apply(pd.to_datetime, format='%Y:%m:%d %H:%M:%S', errors='coerce', exact=False),
+        lambda x: x.value
+    )
+
+
+def old_str_len(df):
+    return applymap(df.astype(str).fillna(''), len)
+
+
+def old_join_columns(df):
+    return df.astype(str).fillna('').apply(' '.join, axis=1)
+
+
+@pytest.fixture(scope='module')
+def pairs():
+    # Pairs of deleted and kept images from the recorded metadata, as passed to the pipeline
+    records = [json.loads(line) for line in DATA.read_text().splitlines()]
+    rows = [
+        {'dhash': bytes.fromhex(record['dhash']), 'metadata': json.dumps(record['metadata']), 'deleted': record['deleted']}
+        for record in records
+    ]
+    deleted = legacy.metadata_frame([row for row in rows if row['deleted']])
+    saved = legacy.metadata_frame([row for row in rows if not row['deleted']])
+    X, _ = legacy.join(deleted, saved)
+    return X
+
+
+def test_to_datetime_value(pairs):
+    dates = legacy.DateReindexTransformer().fit_transform(pairs)
+    assert not dates.empty
+    pd.testing.assert_frame_equal(legacy.to_datetime_value(dates), old_to_datetime_value(dates), check_dtype=False)
+
+
+def test_str_len(pairs):
+    strings = legacy.StringReindexTransformer().fit_transform(pairs)
+    assert not strings.empty
+    pd.testing.assert_frame_equal(legacy.str_len(strings), old_str_len(strings), check_dtype=False)
+
+
+def test_join_columns(pairs):
+    strings = legacy.StringReindexTransformer().fit_transform(pairs)
+    l, r = split(strings)
+    for side in (l, r):
+        pd.testing.assert_series_equal(legacy.TokenizerTransformer._join_columns(side), old_join_columns(side))
+
+
+def test_join_columns_empty():
+    df = pd.DataFrame(index=range(3))
+    pd.testing.assert_series_equal(
+        legacy.TokenizerTransformer._join_columns(df),
+        pd.Series('', index=df.index),
+    )
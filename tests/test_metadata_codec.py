@@ -0,0 +1,21 @@
+import json
+
+import metadata_codec
+
+
+def test_dictionary_keeps_repeated_fragments_after_long_unique_ones():
+    samples = [
+        {'SourceFile': '/photo/2019/07/14/' + 'a' * 200 + '.jpg', 'MIMEType': 'image/jpeg'},
+        {'SourceFile': '/photo/2019/07/15/' + 'b' * 200 + '.jpg', 'MIMEType': 'image/jpeg'},
+    ]
+    dictionary = metadata_codec.build_dictionary(samples)
+    assert b'"MIMEType":"image/jpeg"' in dictionary
+    assert b'a' * 200 not in dictionary
+
+
+def test_round_trip():
+    metadata = {'SourceFile': '/a/1.jpg', 'Keywords': ['x', 'é'], 'ISO': 100}
+    dictionary = metadata_codec.build_dictionary([metadata, metadata])
+    blob = metadata_codec.encode(metadata, 3, dictionary)
+    assert metadata_codec.dictionary_id(blob) == 3
+    assert json.loads(metadata_codec.decode(blob, {3: dictionary})) == metadata
@@ -0,0 +1,38 @@
+import os
+
+import numpy as np
+from sklearn.base import clone
+
+from db import DB
+from learn.cmp import pipeline
+from learn.predictor import Predictor, image_vectors
+from learn.features import pair_features
+
+
+def metadata(file_name, size):
+    return {'SourceFile': file_name, 'FileName': os.path.basename(file_name), 'FileSize': size, 'MIMEType': 'image/jpeg'}
+
+
+def test_single_deletion(tmp_path):
+    # One deleted and one kept image give two pairs, too few for the training split to hold both classes
+    dhash = bytes(16)
+    with DB(tmp_path) as db:
+        for file_name, size in [('/a/kept.jpg', 2000), ('/b/deleted.jpg', 1000)]:
+            db.image_insert_or_replace(file_name=file_name, mtime=1, size=size, dhash=dhash, metadata=metadata(file_name, size))
+        db.flush()
+        db.image_delete('/b/deleted.jpg', log=True)
+        group = [metadata('/a/kept.jpg', 2000), metadata('/c/copy.jpg', 500)]
+        for _ in range(10):
+            predictor = Predictor(tmp_path)
+            predictor.train(db)
+            assert predictor.pipeline is None or len(predictor.pipeline.classes_) == 2
+            assert sorted(m['SourceFile'] for m in predictor(db, [group])[0]) == ['/a/kept.jpg', '/c/copy.jpg']
+
+
+def test_rank_with_one_class(tmp_path):
+    group = [metadata('/a/1.jpg', 2000), metadata('/a/2.jpg', 1000)]
+    with DB(tmp_path) as db:
+        vectors = image_vectors(db, [m['SourceFile'] for m in group], group)
+        predictor = Predictor(tmp_path)
+        predictor.pipeline = clone(pipeline).fit(pair_features(vectors, [0], [1]), np.array([-1]))
+        assert predictor(db, [group]) == [group]